@@ -0,0 +1,71 @@
+"""
+Reports the recall of LSHDecoder with and without multi-probing against the exact thresholded graph, for a range of
+band counts. Recall is the fraction of node pairs with a similarity of at least the threshold that LSH finds.
+
+Usage: python graph/benchmarks/multiprobe_recall.py --embeddings graph/embeddings/Cora_cosine.pt --min-sim 0.99
+Without --embeddings, clustered random embeddings are used.
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(osp.dirname(osp.dirname(osp.dirname(osp.abspath(__file__)))))
+
+from graph.torch_lsh import LSHDecoder, load_embeddings
+from graph.utils import sample_percentile
+
+
+def clustered_embeddings(n_nodes, dim, n_clusters, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn((n_clusters, dim), generator=generator)
+    assignment = torch.randint(n_clusters, (n_nodes,), generator=generator)
+    return centers[assignment] + 0.3 * torch.randn((n_nodes, dim), generator=generator)
+
+
+def exact_pair_keys(z, min_sim):
+    z = z / torch.norm(z, dim=1)[:, None]
+    rows, cols = (torch.mm(z, z.t()) >= min_sim).triu(diagonal=1).nonzero().t()
+    return (rows * z.size(0) + cols).numpy()
+
+
+def lsh_pair_keys(adjacency, n_nodes):
+    rows, cols = adjacency.coalesce().indices()
+    upper = rows < cols
+    return (rows[upper] * n_nodes + cols[upper]).numpy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--embeddings', type=str, default=None, help="Embeddings saved with --save-embeddings")
+    parser.add_argument('--n-nodes', type=int, default=10000, help="Number of random nodes without --embeddings")
+    parser.add_argument('--min-sim', type=float, default=0.99, help="Similarity PERCENTILE threshold")
+    parser.add_argument('--rows', type=int, default=16, help="Rows per band")
+    parser.add_argument('--bands', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--probes', type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.embeddings is not None:
+        z = torch.as_tensor(load_embeddings(args.embeddings)).detach().float().cpu()
+    else:
+        z = clustered_embeddings(args.n_nodes, 16, 50)
+
+    min_sim, _ = sample_percentile(args.min_sim, z, dist_measure='cosine')
+    true_keys = exact_pair_keys(z, min_sim)
+    print(f"{len(z)} nodes, {len(true_keys)} pairs with similarity >= {min_sim:.4f}")
+
+    print(f"{'bands':>6} {'probes':>7} {'recall':>8} {'candidates':>12} {'time [s]':>10}")
+    for bands in args.bands:
+        for n_probes in args.probes:
+            decoder = LSHDecoder(sim_thresh=min_sim, bands=bands, rows=args.rows, seed=args.seed, n_probes=n_probes)
+
+            t = time.time()
+            adjacency = decoder(z)
+            elapsed = time.time() - t
+
+            recall = np.isin(true_keys, lsh_pair_keys(adjacency, len(z))).mean() if len(true_keys) else 1.0
+            print(f"{bands:>6} {n_probes:>7} {recall:>8.4f} {decoder.n_verified:>12} {elapsed:>10.3f}")
@@ -0,0 +1,110 @@
+"""
+Benchmarks collecting LSH candidate pairs with repeated torch.cat calls (as LSHDecoder.recover_duplicates used to)
+against the geometrically growing PairAccumulator. Every measurement runs in a fresh process so that the peak memory
+of one run does not hide the one of the next.
+
+Usage: python graph/benchmarks/pair_accumulator.py --n-pairs 100000 1000000
+"""
+import argparse
+import multiprocessing as mp
+import os.path as osp
+import resource
+import sys
+import time
+
+import torch
+
+sys.path.append(osp.dirname(osp.dirname(osp.dirname(osp.abspath(__file__)))))
+
+from graph.torch_lsh import PairAccumulator
+
+
+def _buckets(n_pairs, pairs_per_bucket, n_nodes, device):
+    generator = torch.Generator().manual_seed(0)
+    n_buckets = max(1, n_pairs // pairs_per_bucket)
+
+    for _ in range(n_buckets):
+        indices = torch.randint(n_nodes, (pairs_per_bucket, 2), generator=generator).to(device)
+        values = torch.rand(pairs_per_bucket, generator=generator).to(device)
+        yield indices, values
+
+
+def concat_pairs(buckets, n_nodes, device):
+    pairs_indices = torch.LongTensor().to(device)
+    pairs_similarites = torch.FloatTensor().to(device)
+
+    for indices, values in buckets:
+        pairs_similarites = torch.cat((pairs_similarites, values), dim=0)
+        pairs_indices = torch.cat((pairs_indices, indices), dim=0)
+
+    return torch.sparse.FloatTensor(indices=pairs_indices.t(), values=pairs_similarites,
+                                    size=torch.Size([n_nodes, n_nodes]))
+
+
+def accumulate_pairs(buckets, n_nodes, device):
+    pairs = PairAccumulator(device=device)
+
+    for indices, values in buckets:
+        pairs.append(indices[:, 0], indices[:, 1], values)
+
+    return pairs.to_sparse(n_nodes)
+
+
+METHODS = {'torch.cat': concat_pairs, 'accumulator': accumulate_pairs}
+
+
+def _peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 10 ** 6
+
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 10 ** 3
+
+
+def _run(method, n_pairs, pairs_per_bucket, n_nodes, device_name, results):
+    device = torch.device(device_name)
+
+    # Generate the input up front so it does not count towards the measured time
+    buckets = list(_buckets(n_pairs, pairs_per_bucket, n_nodes, device))
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    baseline = _peak_memory_mb(device)
+
+    t = time.time()
+    matrix = METHODS[method](buckets, n_nodes, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.time() - t
+
+    results.put((elapsed, _peak_memory_mb(device) - baseline, matrix._nnz()))
+
+
+def benchmark(method, n_pairs, pairs_per_bucket, n_nodes, device_name):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+
+    process = ctx.Process(target=_run, args=(method, n_pairs, pairs_per_bucket, n_nodes, device_name, results))
+    process.start()
+    result = results.get()
+    process.join()
+
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-pairs', type=int, nargs='+', default=[10 ** 5, 10 ** 6],
+                        help="Total numbers of candidate pairs to collect")
+    parser.add_argument('--pairs-per-bucket', type=int, default=100, help="Pairs appended per bucket")
+    parser.add_argument('--n-nodes', type=int, default=400000, help="Number of nodes in the graph")
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    print(f"{'pairs':>10} {'method':>12} {'time [s]':>10} {'peak memory [MB]':>18}")
+
+    for n_pairs in args.n_pairs:
+        for method in METHODS:
+            elapsed, peak, nnz = benchmark(method, n_pairs, args.pairs_per_bucket, args.n_nodes, args.device)
+            assert nnz == n_pairs // args.pairs_per_bucket * args.pairs_per_bucket
+            print(f"{n_pairs:>10} {method:>12} {elapsed:>10.3f} {peak:>18.1f}")
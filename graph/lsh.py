@@ -1,56 +1,179 @@
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from tqdm import tqdm
 
 
+# Number of candidate pairs whose distances are computed at once
+PAIR_CHUNK_SIZE = 2 ** 16
+
+
+# The distance functions work row-wise on arrays of shape [n_pairs, D] as well as on single vectors
 def cosine_dist(v1, v2, use_tensors):
-    return 1 - (v1 @ v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
+    return 1 - np.sum(v1 * v2, axis=-1) / (np.linalg.norm(v1, axis=-1) * np.linalg.norm(v2, axis=-1))
 
 
 def euclidean_dist(v1, v2, use_tensors):
-    return np.linalg.norm(v1 - v2)
+    return np.linalg.norm(v1 - v2, axis=-1)
 
 
 def dot_product(v1, v2, use_tensors):
-    return torch.dot(v1, v2) if use_tensors else v1 @ v2
+    return torch.sum(v1 * v2, dim=-1) if use_tensors else np.sum(v1 * v2, axis=-1)
 
 
-def cosine_signature(X, b, r, use_tensors):
-    N, D = X.shape
-    random_projections = np.random.multivariate_normal(mean=np.zeros(D), cov=np.eye(D), size=b * r)
+def random_generator(seed=None):
+    """Create the numpy Generator that draws the random projections.
 
-    inside = torch.mm(torch.tensor(random_projections, dtype=torch.float),
-                      X.t()) if use_tensors else random_projections @ X.T
-    return (inside >= 0) * 2 - 1
+    Without a seed, one is taken from the global numpy RNG, so that np.random.seed still makes runs reproducible.
+    """
+    return np.random.default_rng(seed if seed is not None else np.random.randint(2 ** 31))
 
 
-def euclidean_signature(X, b, r, use_tensors, w=0.25):
-    N, D = X.shape
-    random_projections = np.random.multivariate_normal(mean=np.zeros(D), cov=np.eye(D), size=b * r)
-    bias = np.random.uniform(0, w, size=b * r)
+def as_float32(X):
+    X = X.detach().cpu().numpy() if torch.is_tensor(X) else np.asarray(X)
+    return X.astype(np.float32, copy=False)
 
-    sketch = (torch.mm(torch.tensor(random_projections, dtype=torch.float), X.t()) + torch.tensor(bias[np.newaxis].T,
-                                                                                                  dtype=torch.float)) / torch.tensor(
-        w, dtype=torch.float) if use_tensors else (random_projections @ X.T + bias[np.newaxis].T) / w
 
-    return torch.floor(sketch) if use_tensors else np.floor(sketch)
+def sorted_unique(keys):
+    """Sorted distinct values of an int64 array, same as np.unique.
 
+    np.unique hashes instead of sorting in recent numpy versions, which is much slower for int64 keys.
+    """
+    keys = np.sort(keys)
+    distinct = np.ones(len(keys), dtype=bool)
+    distinct[1:] = keys[1:] != keys[:-1]
+    return keys[distinct]
 
-def dot_signature(X, b, r, use_tensors):
-    N, D = X.shape
+
+def projection_chunks(X, n_projections, rng, chunk_size=None):
+    """Project X onto standard normal vectors, at most chunk_size of them at a time.
+
+    Only chunk_size x N projected values are held in memory at once, however large n_projections is. The
+    projections do not depend on chunk_size, since chunks are consecutive draws from rng.
+
+    Yields
+    ------
+    start : int
+        Index of the first projection in the chunk.
+    projected : np.array shape [chunk_size, N]
+        float32 projections of X.
+    """
+    chunk_size = chunk_size or n_projections
+
+    for start in range(0, n_projections, chunk_size):
+        projections = rng.standard_normal((min(chunk_size, n_projections - start), X.shape[1]), dtype=np.float32)
+        yield start, projections @ X.T
+
+
+def cosine_signature(X, b, r, use_tensors, rng=None, chunk_size=None):
+    X = as_float32(X)
+    rng = rng if rng is not None else random_generator()
+
+    signature = np.empty((b * r, X.shape[0]), dtype=np.int8)
+    for start, inside in projection_chunks(X, b * r, rng, chunk_size):
+        signature[start: start + len(inside)] = np.where(inside >= 0, np.int8(1), np.int8(-1))
+
+    return torch.from_numpy(signature) if use_tensors else signature
+
+
+def euclidean_signature(X, b, r, use_tensors, w=0.25, rng=None, chunk_size=None):
+    X = as_float32(X)
+    rng = rng if rng is not None else random_generator()
+    bias = rng.uniform(0, w, size=b * r).astype(np.float32)
+
+    signature = np.empty((b * r, X.shape[0]), dtype=np.int32)
+    for start, projected in projection_chunks(X, b * r, rng, chunk_size):
+        sketch = (projected + bias[start: start + len(projected), np.newaxis]) / np.float32(w)
+        signature[start: start + len(projected)] = np.floor(sketch)
+
+    return torch.from_numpy(signature) if use_tensors else signature
+
+
+def dot_signature(X, b, r, use_tensors, rng=None, chunk_size=None):
+    X = as_float32(X)
     normalized = X / np.linalg.norm(X, axis=1).max()
-    augment_col = np.sqrt(1 - np.linalg.norm(normalized, axis=1))[np.newaxis].T
+    # Lift all vectors onto the unit sphere, so that the inner product of the originals is a cosine of the lifts
+    augment_col = np.sqrt(np.maximum(1 - np.sum(normalized ** 2, axis=1), 0))[np.newaxis].T
     augmented = np.concatenate((normalized, augment_col), axis=1)
-    random_vectors = np.random.multivariate_normal(mean=np.zeros(D + 1), cov=np.eye(D + 1), size=b * r)
 
-    sketch = (random_vectors @ augmented.T >= 0) * 2 - 1
+    return cosine_signature(augmented, b, r, use_tensors, rng=rng, chunk_size=chunk_size)
+
 
-    return torch.tensor(sketch, dtype=torch.float) if use_tensors else sketch
+def band_buckets(band_matrix):
+    """Group the nodes of a band into buckets of identical columns.
 
+    Parameters
+    ----------
+    band_matrix : np.array shape [r, N]
+        Boolean band of the signature matrix.
 
-def LSH(X, b=8, r=32, d=0.3, dist_func='cosine', debug=False, use_tensors=True):
+    Returns
+    -------
+    nodes : np.array shape [N]
+        Node IDs grouped by bucket and ascending within each bucket.
+    offsets, counts : np.array
+        Start of each bucket in nodes and its number of nodes.
+    """
+    # Pack the bits of every column into bytes and compare each packed column as a single opaque value
+    keys = np.ascontiguousarray(np.packbits(band_matrix, axis=0).T)
+    keys = keys.view(np.dtype((np.void, keys.shape[1]))).ravel()
+
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    nodes = np.argsort(inverse.ravel(), kind='stable')
+    offsets = np.cumsum(counts) - counts
+
+    return nodes, offsets, counts
+
+
+def bucket_pairs(nodes, offsets, counts):
+    """Enumerate all pairs of nodes that share a bucket.
+
+    Returns
+    -------
+    rows, cols : np.array
+        Node IDs of the pairs with rows < cols.
+    """
+    # Every node is paired with the nodes after it in its bucket
+    bucket = np.repeat(np.arange(len(counts)), counts)
+    n_partners = counts[bucket] - (np.arange(len(nodes)) - offsets[bucket]) - 1
+
+    row_positions = np.repeat(np.arange(len(nodes)), n_partners)
+    first_pair = np.cumsum(n_partners) - n_partners
+    col_positions = row_positions + 1 + np.arange(len(row_positions)) - np.repeat(first_pair, n_partners)
+
+    return nodes[row_positions], nodes[col_positions]
+
+
+def hash_band(signature_matrix, band, r):
+    """Hash the nodes of a single band and return its candidate pairs.
+
+    Returns
+    -------
+    rows, cols : np.array
+        Node IDs of the candidate pairs with rows < cols.
+    buckets : tuple
+        (nodes, offsets, counts) as returned by band_buckets.
+    """
+    ix = band * r
+    band_matrix = signature_matrix[ix: ix + r]
+    band_matrix = band_matrix == band_matrix[0, :]
+
+    buckets = band_buckets(band_matrix)
+
+    return bucket_pairs(*buckets) + (buckets,)
+
+
+def pair_distances(X, rows, cols, dist_func, use_tensors):
+    """Compute the distances of the given pairs in chunks of PAIR_CHUNK_SIZE pairs."""
+    distances = [dist_func(X[rows[i: i + PAIR_CHUNK_SIZE]], X[cols[i: i + PAIR_CHUNK_SIZE]], use_tensors)
+                 for i in range(0, len(rows), PAIR_CHUNK_SIZE)]
+
+    return np.concatenate(distances) if distances else np.zeros(0, dtype=X.dtype)
+
+
+def LSH(X, b=8, r=32, d=0.3, dist_func='cosine', debug=False, use_tensors=True, n_jobs=1, seed=None,
+        chunk_size=None):
     """Find candidate duplicate pairs using LSH and refine using exact cosine distance.
     
     Parameters
@@ -65,23 +188,26 @@ def LSH(X, b=8, r=32, d=0.3, dist_func='cosine', debug=False, use_tensors=True):
         Distance treshold for reporting duplicates.
     dist_func: str
         Which distance function to use, from ['cosine', 'euclidean', 'dot']
+    n_jobs : int
+        Number of threads hashing the bands in parallel.
+    seed : int
+        Seed of the random projections, drawn from the global numpy RNG if not given.
+    chunk_size : int
+        Number of random projections computed at once, all b * r if not given.
     
     Returns
     -------
-    duplicates : {(ID1, ID2, d_{12}), ..., (IDX, IDY, d_{xy})}
-        A set of tuples indicating the detected duplicates.
-        Each tuple should have 3 elements:
-            * ID of the first song
-            * ID of the second song
-            * The cosine distance between them
+    duplicates : (rows, cols, dists)
+        Arrays describing the detected duplicates, one entry per pair:
+            * rows: ID of the first node
+            * cols: ID of the second node, rows < cols
+            * dists: The distance between them
     
     n_candidates : int
         Number of detected candidate pairs.
         
     """
-    n_candidates = 0
-    duplicates = set()
-    d = np.asscalar(d) if type(d) is np.ndarray else d
+    d = float(d)
 
     assert dist_func in ['cosine', 'euclidean', 'dot']
 
@@ -99,41 +225,39 @@ def LSH(X, b=8, r=32, d=0.3, dist_func='cosine', debug=False, use_tensors=True):
 
     N, D = X.shape
 
-    signature_matrix = signature_func(X, b, r, use_tensors)
-
-    for band in tqdm(range(b)):
+    signature_matrix = signature_func(X, b, r, use_tensors, rng=random_generator(seed), chunk_size=chunk_size)
 
-        hashes = defaultdict(list)
+    # The hashing and the verification run on numpy arrays
+    X = X.detach().cpu().numpy() if torch.is_tensor(X) else np.asarray(X)
+    signature_matrix = np.asarray(signature_matrix)
 
-        ix = band * r
-        band_matrix = signature_matrix[ix: ix + r]
-        band_matrix = band_matrix == band_matrix[0, :]
+    def run_band(band):
+        return hash_band(signature_matrix, band, r)
 
-        for i in range(N):
-            if use_tensors:
-                hashes[hash(band_matrix[:, i].numpy().tostring())].append(i)
-            else:
-                hashes[hash(band_matrix[:, i].tostring())].append(i)
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(tqdm(executor.map(run_band, range(b)), total=b))
+    else:
+        results = [run_band(band) for band in tqdm(range(b))]
 
-        for (h, dups) in hashes.items():
-            if len(dups) <= 1:
-                continue
+    rows = np.concatenate([band_rows for band_rows, _, _ in results])
+    cols = np.concatenate([band_cols for _, band_cols, _ in results])
+    n_candidates = len(rows)
 
-            for i in range(len(dups)):
-                n1 = dups[i]
+    # Pairs sharing a bucket in several bands are only verified once
+    keys = sorted_unique(rows.astype(np.int64) * N + cols)
+    rows, cols = keys // N, keys % N
 
-                for j in range(i + 1, len(dups)):
-                    n2 = dups[j]
-                    n_candidates += 1
+    distances = pair_distances(X, rows, cols, dist_func, False)
 
-                    real_dist = dist_func(X[dups[i]], X[dups[j]], use_tensors)
+    # For dot product we aim to find maximizing pairs
+    found = distances > d if dist_func is dot_product else distances < d
+    duplicates = rows[found], cols[found], distances[found]
 
-                    # For dot product we aim to find maximizing pairs
-                    if dist_func is not dot_product:
-                        if real_dist < d:
-                            duplicates.add((dups[i], dups[j], real_dist))
-                    else:
-                        if real_dist > d:
-                            duplicates.add((dups[i], dups[j], real_dist))
+    if debug:
+        # Buckets of the last band
+        nodes, offsets, counts = results[-1][2]
+        return duplicates, {i: nodes[offset: offset + count].tolist()
+                            for i, (offset, count) in enumerate(zip(offsets, counts))}
 
-    return duplicates, n_candidates if not debug else hashes
+    return duplicates, n_candidates
@@ -0,0 +1,173 @@
+import os.path as path
+import sys
+from collections import defaultdict
+
+import torch
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from graph.torch_lsh import CosineSimilarity
+
+
+class LSHIndex(object):
+    """
+    Persistent LSH index over node embeddings with incremental inserts, removals and neighbor queries.
+    Nodes are hashed with the bit-packed signatures of CosineSimilarity into one hash table per band, so adding or
+    removing a node costs O(bands) table updates instead of a full rebuild.
+    """
+
+    def __init__(self, dim: int, bands: int = 16, rows: int = 8, seed: int = None):
+        self.dim = dim
+        self.bands = bands
+        self.rows = rows
+        self.metric = CosineSimilarity(bands, rows, seed=seed)
+
+        # One hash table per band mapping a packed bucket key to the ids of its nodes
+        self.tables = [defaultdict(set) for _ in range(bands)]
+        # Bucket keys of every indexed id, needed to remove it again
+        self.keys = {}
+
+        # Embeddings are kept in a buffer that grows geometrically, freed slots are reused
+        self.vectors = torch.empty((0, dim))
+        self.slots = {}
+        self.slot_ids = []
+        self.free_slots = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, node_id):
+        return node_id in self.slots
+
+    def _band_keys(self, embeddings):
+        """
+        :return: list with the tuple of bucket keys of all bands for every embedding
+        """
+        packed = self.metric.packed_signature(embeddings.detach().cpu())
+
+        # (n_samples, bands, words) -> one tuple of words per band and node
+        return [[tuple(words) for words in node_keys] for node_keys in packed.permute(2, 0, 1).tolist()]
+
+    def _allocate_slot(self):
+        if self.free_slots:
+            return self.free_slots.pop()
+
+        slot = len(self.slot_ids)
+        if slot == self.vectors.size(0):
+            vectors = torch.empty((max(16, 2 * slot), self.dim))
+            vectors[:slot] = self.vectors
+            self.vectors = vectors
+
+        self.slot_ids.append(None)
+        return slot
+
+    def add(self, embeddings: torch.Tensor, ids):
+        """
+        Inserts nodes into the index, replacing nodes that are already indexed under the same id. Of ids that occur
+        several times, the last embedding is indexed.
+        :param embeddings: tensor of shape (n_samples, dim)
+        :param ids: n_samples hashable node ids
+        """
+        ids = list(ids)
+        assert embeddings.shape == (len(ids), self.dim), "Need one embedding of size dim for every id"
+
+        last = {node_id: i for i, node_id in enumerate(ids)}
+        if len(last) < len(ids):
+            embeddings = embeddings[torch.tensor(list(last.values()), dtype=torch.long)]
+            ids = list(last)
+
+        self.remove([node_id for node_id in ids if node_id in self])
+
+        for node_id, embedding, node_keys in zip(ids, embeddings.detach().cpu(), self._band_keys(embeddings)):
+            slot = self._allocate_slot()
+            self.vectors[slot] = embedding
+            self.slots[node_id] = slot
+            self.slot_ids[slot] = node_id
+
+            self.keys[node_id] = node_keys
+            for table, key in zip(self.tables, node_keys):
+                table[key].add(node_id)
+
+    def remove(self, ids):
+        """
+        Removes nodes from the index. Unknown ids are ignored.
+        """
+        for node_id in ids:
+            if node_id not in self:
+                continue
+
+            for table, key in zip(self.tables, self.keys.pop(node_id)):
+                bucket = table[key]
+                bucket.discard(node_id)
+                if not bucket:
+                    del table[key]
+
+            slot = self.slots.pop(node_id)
+            self.slot_ids[slot] = None
+            self.free_slots.append(slot)
+
+    def query(self, embeddings: torch.Tensor, threshold: float = None, k: int = None):
+        """
+        Finds indexed nodes similar to the given embeddings among the nodes sharing at least one bucket with them.
+        Indexed nodes identical to a query embedding are part of its result as well.
+        :param embeddings: tensor of shape (n_queries, dim)
+        :param threshold: Only return neighbors with at least this similarity
+        :param k: Only return the k most similar neighbors
+        :return: list with a (ids, similarities) tuple for every query, sorted by decreasing similarity
+        """
+        results = []
+
+        for embedding, node_keys in zip(embeddings.detach().cpu(), self._band_keys(embeddings)):
+            candidates = set()
+            for table, key in zip(self.tables, node_keys):
+                candidates.update(table.get(key, ()))
+
+            candidates = list(candidates)
+            slots = torch.tensor([self.slots[node_id] for node_id in candidates], dtype=torch.long)
+            similarities = self.metric.paired_sim(embedding.expand(len(candidates), self.dim), self.vectors[slots])
+
+            if threshold is not None:
+                similarities[similarities < threshold] = -float('inf')
+
+            similarities, order = torch.sort(similarities, descending=True)
+            n_results = int((similarities > -float('inf')).sum())
+            if k is not None:
+                n_results = min(n_results, k)
+
+            results.append(([candidates[i] for i in order[:n_results].tolist()], similarities[:n_results]))
+
+        return results
+
+    def state_dict(self):
+        ids = list(self.slots)
+        slots = torch.tensor([self.slots[node_id] for node_id in ids], dtype=torch.long)
+
+        return {'dim': self.dim,
+                'bands': self.bands,
+                'rows': self.rows,
+                'hyperplanes': self.metric.hyperplanes.state_dict(),
+                'ids': ids,
+                'vectors': self.vectors[slots],
+                'keys': [self.keys[node_id] for node_id in ids]}
+
+    def save(self, file_path: str):
+        torch.save(self.state_dict(), file_path)
+
+    @classmethod
+    def load(cls, file_path: str):
+        # The ids can be any hashable objects, which the restricted weights_only unpickler rejects
+        state = torch.load(file_path, weights_only=False)
+
+        index = cls(state['dim'], bands=state['bands'], rows=state['rows'])
+        index.metric.hyperplanes.load_state_dict(state['hyperplanes'])
+
+        # Restore the tables from the stored keys instead of hashing all nodes again
+        index.vectors = state['vectors'].clone()
+        for slot, (node_id, node_keys) in enumerate(zip(state['ids'], state['keys'])):
+            index.slots[node_id] = slot
+            index.slot_ids.append(node_id)
+            index.keys[node_id] = node_keys
+            for table, key in zip(index.tables, node_keys):
+                table[key].add(node_id)
+
+        return index
@@ -1,14 +1,16 @@
 import sys
+from abc import ABC, abstractmethod
 from os.path import dirname, abspath
 
 import scipy.sparse as sparse
+import torch_geometric.nn
 from scipy.special import expit
 from torch.nn import functional as F
 from torch_geometric.nn import GCNConv
-from torch_geometric.nn import InnerProductDecoder
 
 sys.path.append(dirname(abspath(__file__)))
 from graph.lsh import *
+from graph.torch_lsh import PairAccumulator
 
 
 def _norm_batch(batch):
@@ -21,7 +23,69 @@ def _norm_batch(batch):
     return batch / batch.norm(dim=1)[:, None]
 
 
-class CosineSimDecoder(torch.nn.Module):
+class BlockwiseDecoder(ABC):
+    """
+    Exact graph construction for decoders that implement forward_block. Similarities are computed for one block of
+    rows at a time and thresholded or reduced to the top-k right away, so only O(block_size * N) similarities are in
+    memory instead of the O(N^2) of forward_all.
+    """
+
+    @abstractmethod
+    def forward_block(self, z_block, z, sigmoid=True):
+        """
+        :return: similarities of every node in z_block to all nodes in z, shape [block_size, n_nodes]
+        """
+        pass
+
+    def forward_blocks(self, z, block_size=1024, sigmoid=True):
+        """
+        Blocks are computed without autograd, otherwise every block would stay referenced by the graph and memory
+        would grow to O(N^2) again
+        :return: generator of (start, block) with the rows start to start + block_size of forward_all(z, sigmoid)
+        """
+        for start in range(0, z.size(0), block_size):
+            with torch.no_grad():
+                block = self.forward_block(z[start:start + block_size], z, sigmoid=sigmoid)
+            yield start, block
+
+    def forward_thresholded(self, z, min_sim, block_size=1024, sigmoid=True):
+        """
+        Exact thresholded graph with the same entries as forward_all(z, sigmoid) > min_sim, including the diagonal
+        :return: coalesced sparse COO tensor of shape [n_nodes, n_nodes]
+        """
+        n_nodes = z.size(0)
+        pairs = PairAccumulator(device=z.device)
+
+        for start, block in self.forward_blocks(z, block_size, sigmoid):
+            rows, cols = (block > min_sim).nonzero(as_tuple=True)
+            pairs.append(rows + start, cols, block[rows, cols])
+
+        # Blocks are emitted in row-major order, so the pairs are sorted and distinct already
+        return pairs.to_sparse(n_nodes).coalesce()
+
+    def forward_topk(self, z, k, block_size=1024, sigmoid=True):
+        """
+        Exact k nearest neighbors of every node, excluding the node itself
+        :return: (indices, similarities) tensors of shape [n_nodes, k], sorted by decreasing similarity. If k is at
+         least n_nodes, the columns after the n_nodes - 1 other nodes are padded with index -1 and similarity -inf
+        """
+        n_nodes = z.size(0)
+        indices = torch.full((n_nodes, k), -1, dtype=torch.long, device=z.device)
+        similarities = torch.full((n_nodes, k), -np.inf, device=z.device)
+        n_neighbors = min(k, n_nodes - 1)
+
+        for start, block in self.forward_blocks(z, block_size, sigmoid):
+            block_rows = torch.arange(block.size(0), device=block.device)
+            block[block_rows, block_rows + start] = -np.inf
+
+            block_similarities, block_indices = torch.topk(block, n_neighbors, dim=1)
+            indices[start:start + block.size(0), :n_neighbors] = block_indices
+            similarities[start:start + block.size(0), :n_neighbors] = block_similarities
+
+        return indices, similarities
+
+
+class CosineSimDecoder(BlockwiseDecoder, torch.nn.Module):
     """
     Calculates pairwise similarity of embeddings using the cosine similarity.
     cos_sim(u, v) = dot(u, v) / (norm(u) * norm(v))
@@ -52,6 +116,10 @@ class CosineSimDecoder(torch.nn.Module):
         values = torch.mm(z, z.t())
         return torch.sigmoid(values) if sigmoid else values
 
+    def forward_block(self, z_block, z, sigmoid=True):
+        values = torch.mm(_norm_batch(z_block), _norm_batch(z).t())
+        return torch.sigmoid(values) if sigmoid else values
+
 
 class CosineSimHashDecoder(CosineSimDecoder):
     def forward_all(self, z, sigmoid=True, d=0.25):
@@ -59,7 +127,7 @@ class CosineSimHashDecoder(CosineSimDecoder):
 
         pairs, _ = LSH(z.detach().cpu(), d=d, b=8, r=32)
 
-        v1s, v2s, ds = zip(*(list(pairs)))
+        v1s, v2s, ds = pairs
 
         diag_indices = np.diag_indices(n_nodes)[0]
 
@@ -71,11 +139,11 @@ class CosineSimHashDecoder(CosineSimDecoder):
             # Zeros get converted to 1s in the transformation below
             ds = np.zeros_like(ds)
 
-        return torch.sparse.FloatTensor(torch.LongTensor([v1s, v2s]), 1 - torch.FloatTensor(ds) / 2,
+        return torch.sparse.FloatTensor(torch.from_numpy(np.stack((v1s, v2s))), 1 - torch.from_numpy(ds).float() / 2,
                                         torch.Size([n_nodes, n_nodes]))
 
 
-class EuclideanDistanceDecoder(torch.nn.Module):
+class EuclideanDistanceDecoder(BlockwiseDecoder, torch.nn.Module):
     """
     Calculates pairwise similarity of embeddings with the L2 norm.
     sim(u, v) = sqrt(sum((u - v)**2))
@@ -98,12 +166,25 @@ class EuclideanDistanceDecoder(torch.nn.Module):
         value = 1.0 - distance  # Euclidean distance in range (0, 2) for normalized vectors
         return torch.sigmoid(value) if sigmoid else value
 
-    def forward_all(self, z, sigmoid=True):
-        # Calculates all pairwise similarities.
-        # Note that using torch.nn.functional.pdist and transforming resulting matrix
-        # to right shape might be faster
-        z = _norm_batch(z)
-        values = 1.0 - torch.norm(z[:, None] - z, dim=2, p=2)
+    def forward_all(self, z, sigmoid=True, block_size=None):
+        """
+        Calculates all pairwise similarities
+        :param block_size: If given, the matrix is computed in blocks of this many rows to bound temporary memory.
+         The blocks are computed without autograd, see forward_blocks
+        :return: tensor of shape [n_nodes, n_nodes]
+        """
+        if block_size is None:
+            return self.forward_block(z, z, sigmoid=sigmoid)
+
+        return torch.cat([block for _, block in self.forward_blocks(z, block_size, sigmoid)])
+
+    def forward_block(self, z_block, z, sigmoid=True):
+        a, b = _norm_batch(z_block), _norm_batch(z)
+
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab avoids the [block_size, n_nodes, n_embed_dim] difference tensor.
+        # Rounding can make it slightly negative for (nearly) identical vectors
+        squared = (a ** 2).sum(dim=1)[:, None] + (b ** 2).sum(dim=1)[None, :] - 2 * torch.mm(a, b.t())
+        values = 1.0 - torch.sqrt(torch.clamp(squared, min=0))
         return torch.sigmoid(values) if sigmoid else values
 
 
@@ -136,23 +217,34 @@ class EuclideanDistanceHashDecoder(EuclideanDistanceDecoder):
 
         pairs, _ = LSH(z, d=dist, dist_func='euclidean', b=4, r=64)
 
-        v1s, v2s, ds = zip(*(list(pairs)))
+        v1s, v2s, ds = pairs
 
         diag_indices = np.diag_indices(n_nodes)[0]
 
         v1s = np.concatenate((v1s, diag_indices))
         v2s = np.concatenate((v2s, diag_indices))
 
-        ds = expit(offset - np.array(ds)) if sigmoid else np.ones_like(ds)
+        ds = expit(offset - ds) if sigmoid else np.ones_like(ds)
         ds = np.concatenate((ds, np.ones(n_nodes)))
 
-        return torch.sparse.FloatTensor(torch.LongTensor([v1s, v2s]), torch.FloatTensor(ds),
+        return torch.sparse.FloatTensor(torch.from_numpy(np.stack((v1s, v2s))), torch.from_numpy(ds).float(),
                                         torch.Size([n_nodes, n_nodes])) if not debug else (
-            torch.sparse.FloatTensor(torch.LongTensor([v1s, v2s]), torch.FloatTensor(ds),
+            torch.sparse.FloatTensor(torch.from_numpy(np.stack((v1s, v2s))), torch.from_numpy(ds).float(),
                                      torch.Size([n_nodes, n_nodes])),
             dist)
 
 
+class InnerProductDecoder(BlockwiseDecoder, torch_geometric.nn.InnerProductDecoder):
+    """
+    Inner product decoder of torch_geometric that can also build its graph block by block.
+    sim(u, v) = dot(u, v)
+    """
+
+    def forward_block(self, z_block, z, sigmoid=True):
+        values = torch.mm(z_block, z.t())
+        return torch.sigmoid(values) if sigmoid else values
+
+
 class InnerProductHashDecoder(InnerProductDecoder):
     def forward_all(self, z, sigmoid=True, d=0.25, debug=False, normalize=False):
 
@@ -178,7 +270,7 @@ class InnerProductHashDecoder(InnerProductDecoder):
 
         pairs, _ = LSH(z, d=dist, dist_func='dot', b=8, r=48)
 
-        v1s, v2s, ds = zip(*(list(pairs)))
+        v1s, v2s, ds = pairs
 
         diag_indices = np.diag_indices(n_nodes)[0]
 
@@ -189,9 +281,9 @@ class InnerProductHashDecoder(InnerProductDecoder):
             ds = expit(ds)
         ds = np.concatenate((ds, np.ones(n_nodes)))
 
-        return torch.sparse.FloatTensor(torch.LongTensor([v1s, v2s]), torch.FloatTensor(ds),
+        return torch.sparse.FloatTensor(torch.from_numpy(np.stack((v1s, v2s))), torch.from_numpy(ds).float(),
                                         torch.Size([n_nodes, n_nodes])) if not debug else (
-            torch.sparse.FloatTensor(torch.LongTensor([v1s, v2s]), torch.FloatTensor(ds),
+            torch.sparse.FloatTensor(torch.from_numpy(np.stack((v1s, v2s))), torch.from_numpy(ds).float(),
                                      torch.Size([n_nodes, n_nodes])),
             dist)
 
@@ -0,0 +1,136 @@
+import copy
+import math
+import os.path as path
+import sys
+from collections import Counter
+
+import torch
+import torch.multiprocessing as mp
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from graph.torch_lsh import LSHDecoder, PairAccumulator, as_tensor
+
+# Odd 64 bit multiplier that mixes the words of a bucket key into the hash choosing its partition
+KEY_HASH_MULTIPLIER = 0x5851F42D4C957F2D
+
+# Shared state of a worker process, set once by the pool initializer
+_worker = {}
+
+
+def partition_keys(band_keys: torch.Tensor, n_partitions: int):
+    """
+    Assigns every bucket key of a band to one of n_partitions. Equal keys always get the same partition, so every
+    bucket ends up completely in one partition.
+    :param band_keys: packed keys of a single band with shape (words, n_samples)
+    :return: LongTensor of shape (n_samples,) with values in [0, n_partitions)
+    """
+    hashes = torch.zeros_like(band_keys[0])
+    for word in band_keys:
+        # int64 products wrap around, which is fine for hashing
+        hashes = (hashes ^ word) * KEY_HASH_MULTIPLIER
+        hashes = hashes ^ (hashes >> 31)
+
+    return hashes % n_partitions
+
+
+def _init_worker(decoder, embeddings, signature):
+    _worker['decoder'] = decoder
+    _worker['embeddings'] = embeddings
+    _worker['signature'] = signature
+    torch.set_num_threads(1)
+
+
+def _signature_shard(bounds):
+    """
+    Map step: writes the signature of the nodes in [start, end) into the shared signature buffer.
+    """
+    start, end = bounds
+    decoder, signature = _worker['decoder'], _worker['signature']
+
+    decoder.sim_metric.packed_signature(_worker['embeddings'][start:end], block_size=decoder.block_size,
+                                        out=signature[:, :, start:end])
+
+
+def _shuffle_shard(bounds, n_partitions):
+    """
+    Shuffle step: sends the nodes in [start, end) of every band to the partition of their bucket key.
+    :return: list over bands with a list of n_partitions ascending LongTensors of nodes each
+    """
+    start, end = bounds
+    signature = _worker['signature']
+
+    shard = []
+    for band in range(signature.size(0)):
+        partitions = partition_keys(signature[band][:, start:end], n_partitions)
+        order = torch.sort(partitions, stable=True)[1]
+        counts = torch.bincount(partitions, minlength=n_partitions)
+        shard.append(list(torch.split(order + start, counts.tolist())))
+
+    return shard
+
+
+def _reduce_partition(band_nodes):
+    """
+    Reduce step: buckets and verifies the nodes of one partition in every band.
+    :return: (PairAccumulator, Counter) with the pairs found in the partition and their statistics
+    """
+    signature = _worker['signature']
+
+    return _worker['decoder']._collect_pairs(signature, _worker['embeddings'], range(signature.size(0)),
+                                             band_nodes=band_nodes)
+
+
+class ShardedLSHDecoder(LSHDecoder):
+    """
+    LSHDecoder that spreads the work over processes, for graphs whose embeddings fit in memory but whose candidate
+    pairs do not fit into a single process.
+    The nodes are split into shards. Every worker computes the signature of its shard into a signature buffer in
+    shared memory. The nodes of every band are then shuffled into partitions by the hash of their bucket key, so
+    that each worker buckets and verifies complete buckets of one partition. This mimics the map, shuffle and
+    reduce steps of a distributed job and returns the same pairs as LSHDecoder.
+    """
+
+    def __init__(self, n_shards: int = 2, **kwargs):
+        """
+        :param n_shards: Number of worker processes and of node shards and key partitions
+        :param kwargs: parameters of LSHDecoder. Multi-probing and k nearest neighbors are not supported
+        """
+        super(ShardedLSHDecoder, self).__init__(**kwargs)
+
+        if self.n_probes > 0 or self.k is not None:
+            raise ValueError("ShardedLSHDecoder supports neither multi-probing nor k nearest neighbors")
+
+        self.n_shards = n_shards
+
+    def forward(self, Z):
+        embeddings = as_tensor(Z).detach().cpu().share_memory_()
+        N, D = embeddings.shape
+
+        signature = torch.zeros((self.bands, self.sim_metric.key_words(), N), dtype=torch.long).share_memory_()
+        shard_size = max(1, math.ceil(N / self.n_shards))
+        shards = [(start, min(start + shard_size, N)) for start in range(0, N, shard_size)]
+
+        # Shards have to be hashed like the whole graph, e.g. lifted by the largest norm of all nodes for
+        # DotProductSimilarity
+        decoder = copy.copy(self)
+        decoder.sim_metric = self.sim_metric.fit(embeddings, block_size=self.block_size)
+
+        # The pickled decoder carries the seed of its hyperplane bank, so all workers use the same hash functions
+        context = mp.get_context('spawn')
+        with context.Pool(self.n_shards, initializer=_init_worker, initargs=(decoder, embeddings, signature)) as pool:
+            pool.map(_signature_shard, shards)
+
+            shuffled = pool.starmap(_shuffle_shard, [(shard, self.n_shards) for shard in shards])
+            partitions = [[torch.cat([shard[band][partition] for shard in shuffled]) for band in range(self.bands)]
+                          for partition in range(self.n_shards)]
+
+            results = pool.map(_reduce_partition, partitions)
+
+        print(f"Size of Signature: {signature.element_size() * signature.nelement() / 10 ** 6}")
+        self._record_stats(sum((result[1] for result in results), Counter()))
+
+        # A pair can share buckets in several partitions of different bands
+        pairs = PairAccumulator.merge([result[0] for result in results], N)
+
+        return self._to_output(pairs, N)
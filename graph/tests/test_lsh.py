@@ -0,0 +1,65 @@
+import sys
+import unittest
+from collections import defaultdict
+from os.path import dirname, abspath
+
+import numpy as np
+import torch
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from graph.lsh import LSH, band_buckets, bucket_pairs, cosine_dist, euclidean_signature, random_generator, sorted_unique
+
+
+class TestLSH(unittest.TestCase):
+
+    def test_bucket_pairs_match_sequential_scan(self):
+        band_matrix = np.random.rand(3, 200) > 0.5
+
+        buckets = defaultdict(list)
+        for i in range(band_matrix.shape[1]):
+            buckets[band_matrix[:, i].tobytes()].append(i)
+        expected = {(dups[i], dups[j]) for dups in buckets.values()
+                    for i in range(len(dups)) for j in range(i + 1, len(dups))}
+
+        rows, cols = bucket_pairs(*band_buckets(band_matrix))
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(set(zip(rows.tolist(), cols.tolist())), expected)
+
+    def test_sorted_unique_matches_np_unique(self):
+        keys = np.random.randint(0, 1000, 5000).astype(np.int64)
+        self.assertTrue(np.array_equal(sorted_unique(keys), np.unique(keys)))
+        self.assertEqual(len(sorted_unique(keys[:0])), 0)
+
+    def test_returns_verified_pairs_once(self):
+        X = torch.randn((300, 8))
+        (rows, cols, dists), n_candidates = LSH(X, b=4, r=4, d=0.3)
+
+        keys = rows * 300 + cols
+        self.assertEqual(len(np.unique(keys)), len(keys))
+        self.assertTrue(n_candidates >= len(keys))
+
+        self.assertTrue((rows < cols).all())
+        self.assertTrue((dists < 0.3).all())
+        self.assertTrue(np.allclose(dists, cosine_dist(X[rows].numpy(), X[cols].numpy(), False), atol=1e-6))
+
+    def test_signature_does_not_depend_on_chunk_size(self):
+        X = np.random.randn(100, 8)
+
+        signature = euclidean_signature(X, 4, 8, False, rng=random_generator(0))
+        chunked = euclidean_signature(X, 4, 8, False, rng=random_generator(0), chunk_size=5)
+        self.assertEqual(signature.shape, (32, 100))
+        self.assertTrue(np.array_equal(signature, chunked))
+
+    def test_seed_makes_result_reproducible(self):
+        X = torch.randn((300, 8))
+
+        (rows, cols, dists), _ = LSH(X, b=4, r=4, d=0.3, seed=1)
+        (seeded_rows, seeded_cols, seeded_dists), _ = LSH(X, b=4, r=4, d=0.3, seed=1, chunk_size=3)
+        self.assertTrue(np.array_equal(rows, seeded_rows))
+        self.assertTrue(np.array_equal(cols, seeded_cols))
+        self.assertTrue(np.array_equal(dists, seeded_dists))
+
+
+if __name__ == '__main__':
+    unittest.main()
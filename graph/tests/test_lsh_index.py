@@ -0,0 +1,98 @@
+import sys
+import tempfile
+import unittest
+from os.path import dirname, abspath, join
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from graph.lsh_index import LSHIndex
+
+
+class TestLSHIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.embeddings = torch.randn((300, 8))
+        self.index = LSHIndex(8, bands=8, rows=4, seed=0)
+        self.index.add(self.embeddings, range(300))
+
+    def test_query_threshold(self):
+        query = self.embeddings[:5] + 0.01
+        results = self.index.query(query, threshold=0.8)
+
+        for embedding, (ids, similarities) in zip(query, results):
+            self.assertTrue((similarities >= 0.8).all())
+            self.assertTrue((similarities[:-1] >= similarities[1:]).all())
+
+            expected = F.cosine_similarity(embedding[None], self.embeddings[ids], dim=1)
+            self.assertTrue(torch.allclose(similarities, expected, atol=1e-6))
+
+        # A slightly moved copy of an indexed node collides with it
+        self.assertEqual(results[0][0][0], 0)
+
+    def test_query_k(self):
+        ids, similarities = self.index.query(self.embeddings[:1], k=3)[0]
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[0], 0)
+
+    def test_add_and_remove(self):
+        new_embedding = self.embeddings[:1] * 2
+        self.index.add(new_embedding, ['new'])
+        self.assertEqual(len(self.index), 301)
+        self.assertIn('new', self.index.query(self.embeddings[:1], threshold=0.99)[0][0])
+
+        self.index.remove(['new', 0])
+        self.assertEqual(len(self.index), 299)
+        ids = self.index.query(self.embeddings[:1], threshold=0.99)[0][0]
+        self.assertNotIn('new', ids)
+        self.assertNotIn(0, ids)
+
+        # Freed slots are reused
+        self.index.add(self.embeddings[:1], [0])
+        self.assertEqual(self.index.vectors.size(0), 512)
+        self.assertIn(0, self.index.query(self.embeddings[:1], threshold=0.99)[0][0])
+
+    def test_add_duplicate_ids(self):
+        self.index.add(torch.stack((self.embeddings[0], -self.embeddings[0])), ['a', 'a'])
+        self.assertEqual(len(self.index), 301)
+        self.assertTrue(torch.equal(self.index.vectors[self.index.slots['a']], -self.embeddings[0]))
+
+        self.index.remove(['a'])
+        self.assertEqual(len(self.index), 300)
+        self.assertNotIn('a', self.index.query(self.embeddings[:1])[0][0])
+        self.assertNotIn('a', self.index.query(-self.embeddings[:1])[0][0])
+
+    def test_save_and_load(self):
+        self.index.remove([1, 2])
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.index.save(join(directory, 'index.pt'))
+            loaded = LSHIndex.load(join(directory, 'index.pt'))
+
+        self.assertEqual(len(loaded), len(self.index))
+
+        query = torch.randn((10, 8))
+        for (ids, similarities), (loaded_ids, loaded_similarities) in zip(self.index.query(query, threshold=0.5),
+                                                                          loaded.query(query, threshold=0.5)):
+            self.assertEqual(set(ids), set(loaded_ids))
+            self.assertTrue(torch.allclose(similarities, loaded_similarities))
+
+    def test_save_and_load_non_int_ids(self):
+        ids = [np.int64(0), 'a', ('b', 1)]
+        index = LSHIndex(8, bands=8, rows=4, seed=0)
+        index.add(self.embeddings[:3], ids)
+
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(join(directory, 'index.pt'))
+            loaded = LSHIndex.load(join(directory, 'index.pt'))
+
+        for node_id in ids:
+            self.assertIn(node_id, loaded)
+        self.assertEqual(loaded.query(self.embeddings[:1], k=1)[0][0], [np.int64(0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
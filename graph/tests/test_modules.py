@@ -0,0 +1,98 @@
+import sys
+import unittest
+from os.path import dirname, abspath
+
+import numpy as np
+import torch
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from graph.modules import BlockwiseDecoder, CosineSimDecoder, EuclideanDistanceDecoder, InnerProductDecoder, _norm_batch
+
+
+class TestBlockwiseDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.z = torch.randn((500, 8))
+        self.decoders = [CosineSimDecoder(), InnerProductDecoder(), EuclideanDistanceDecoder()]
+
+    def test_blocks_match_forward_all(self):
+        for decoder in self.decoders:
+            dense = decoder.forward_all(self.z, sigmoid=False)
+            blocks = torch.cat([block for _, block in decoder.forward_blocks(self.z, block_size=128, sigmoid=False)])
+            self.assertTrue(torch.allclose(blocks, dense, atol=1e-5))
+
+    def test_thresholded_matches_forward_all(self):
+        for decoder in self.decoders:
+            dense = decoder.forward_all(self.z)
+            adj = decoder.forward_thresholded(self.z, 0.9, block_size=70)
+            expected = (dense > 0.9).nonzero().t()
+
+            self.assertTrue(adj.is_coalesced())
+            self.assertTrue(torch.equal(adj.indices(), expected))
+            self.assertTrue(torch.allclose(adj.values(), dense[expected[0], expected[1]], atol=1e-5))
+
+    def test_topk_matches_forward_all(self):
+        for decoder in self.decoders:
+            dense = decoder.forward_all(self.z, sigmoid=False)
+            dense.fill_diagonal_(-np.inf)
+            expected = torch.topk(dense, 5, dim=1)[0]
+
+            indices, similarities = decoder.forward_topk(self.z, 5, block_size=128, sigmoid=False)
+            self.assertEqual(list(indices.size()), [500, 5])
+            self.assertTrue(torch.allclose(similarities, expected, atol=1e-5))
+            self.assertFalse((indices == torch.arange(500)[:, None]).any())
+
+    def test_topk_pads_when_k_exceeds_other_nodes(self):
+        z = torch.randn((4, 8))
+        for decoder in self.decoders:
+            indices, similarities = decoder.forward_topk(z, 10, block_size=3, sigmoid=False)
+            self.assertEqual(list(indices.size()), [4, 10])
+            self.assertEqual(list(similarities.size()), [4, 10])
+
+            for node in range(4):
+                self.assertEqual(sorted(indices[node, :3].tolist()), [other for other in range(4) if other != node])
+            self.assertTrue(torch.isfinite(similarities[:, :3]).all())
+            self.assertTrue((indices[:, 3:] == -1).all())
+            self.assertTrue(torch.isneginf(similarities[:, 3:]).all())
+
+    def test_blocks_do_not_track_gradients(self):
+        z = self.z.clone().requires_grad_()
+        for decoder in self.decoders:
+            self.assertFalse(decoder.forward_thresholded(z, 0.9, block_size=70).requires_grad)
+            self.assertFalse(any(block.requires_grad for _, block in decoder.forward_blocks(z, block_size=128)))
+
+            indices, similarities = decoder.forward_topk(z, 5, block_size=128)
+            self.assertFalse(similarities.requires_grad)
+
+    def test_forward_block_is_abstract(self):
+        with self.assertRaises(TypeError):
+            BlockwiseDecoder()
+
+
+class TestEuclideanDistanceDecoder(unittest.TestCase):
+
+    def test_forward_all_matches_differences(self):
+        z = torch.randn((300, 16))
+        normed = _norm_batch(z)
+        expected = 1.0 - torch.norm(normed[:, None] - normed, dim=2, p=2)
+
+        decoder = EuclideanDistanceDecoder()
+        for block_size in [None, 64]:
+            values = decoder.forward_all(z, sigmoid=False, block_size=block_size)
+            # The self distance is the square root of the rounding error of the expansion
+            self.assertTrue(torch.allclose(values.diagonal(), torch.ones(300), atol=1e-2))
+            self.assertTrue(torch.allclose(values.fill_diagonal_(1.0), expected, atol=1e-5))
+
+    def test_forward_matches_forward_all(self):
+        z = torch.randn((100, 16))
+        edge_index = torch.randint(0, 100, (2, 50))
+        edge_index = edge_index[:, edge_index[0] != edge_index[1]]
+
+        decoder = EuclideanDistanceDecoder()
+        expected = decoder.forward_all(z)[edge_index[0], edge_index[1]]
+        self.assertTrue(torch.allclose(decoder.forward(z, edge_index), expected, atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import sys
+import unittest
+from os.path import dirname, abspath
+
+import torch
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from graph.sharded_lsh import ShardedLSHDecoder, partition_keys
+from graph.torch_lsh import CosineSimilarity, DotProductSimilarity, LSHDecoder
+
+
+class TestShardedLSHDecoder(unittest.TestCase):
+
+    def test_partition_keys(self):
+        keys = torch.randint(-2 ** 62, 2 ** 62, (2, 50))
+        keys = torch.cat((keys, keys), dim=1)
+
+        partitions = partition_keys(keys, 3)
+        self.assertTrue(((partitions >= 0) & (partitions < 3)).all())
+        self.assertTrue(torch.equal(partitions[:50], partitions[50:]))
+
+    def test_matches_single_process(self):
+        # Norms that differ between the shards, so the dot product metric has to lift all of them alike
+        emb = torch.randn((1000, 8)) * torch.linspace(0.1, 1, 1000)[:, None]
+
+        for metric, sim_thresh in [(CosineSimilarity, 0.6), (DotProductSimilarity, 0.5)]:
+            params = dict(bands=4, rows=5, sim_thresh=sim_thresh, metric=metric, seed=0, max_bucket_size=40,
+                          batch_memory=2 ** 16)
+
+            dec = LSHDecoder(**params)
+            adj = dec(emb).coalesce()
+            sharded_dec = ShardedLSHDecoder(n_shards=3, **params)
+            sharded_adj = sharded_dec(emb).coalesce()
+
+            self.assertTrue(adj._nnz() > 0)
+            self.assertTrue(torch.equal(adj.indices(), sharded_adj.indices()))
+            self.assertTrue(torch.equal(adj.values(), sharded_adj.values()))
+            self.assertEqual(dec.bucket_stats, sharded_dec.bucket_stats)
+
+    def test_rejects_neighbors(self):
+        with self.assertRaises(ValueError):
+            ShardedLSHDecoder(bands=4, rows=5, sim_thresh=0.6, k=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,22 @@
 import sys
+import tempfile
 import unittest
-from os.path import dirname, abspath
+from os.path import dirname, abspath, join
 
 import numpy as np
 import torch
 import torch.nn.functional as F
+from torch_geometric.nn import InnerProductDecoder
 
 sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
 
+from graph.modules import EuclideanDistanceDecoder
+
 from graph.torch_lsh import LSHDecoder
-from graph.torch_lsh import CosineSimilarity
+from graph.torch_lsh import CosineSimilarity, DotProductSimilarity, EuclideanDistance
+from graph.torch_lsh import PairAccumulator, PairKeySet
+from graph.torch_lsh import bucket_band, bucket_pairs, pack_signature, tile_pairs, unpack_signature
+from graph.torch_lsh import load_embeddings, load_signature, open_signature
 
 
 class TestCosineSimilarity(unittest.TestCase):
@@ -40,6 +47,268 @@ class TestCosineSimilarity(unittest.TestCase):
 
         self.assertEqual(list(signature_matrix.size()), [bands, rows, N, ])
 
+    def test_packed_signature_matches_signature(self):
+        N, D = 100, 16
+        bands, rows = 4, 70
+
+        X = torch.randn((N, D))
+        sim = CosineSimilarity(bands, rows, seed=0)
+
+        signature_matrix = sim.signature(X)
+        packed = sim.packed_signature(X)
+
+        self.assertEqual(list(packed.size()), [bands, 2, N])
+        self.assertTrue(torch.equal(packed, pack_signature(signature_matrix)))
+        self.assertTrue(torch.equal(unpack_signature(packed, rows), signature_matrix))
+
+    def test_probe_keys_flip_smallest_margin(self):
+        N, D = 50, 8
+        bands, rows = 2, 70
+
+        X = torch.randn((N, D))
+        sim = CosineSimilarity(bands, rows, seed=0)
+        packed = sim.packed_signature(X)
+
+        probes = sim.probe_keys(X, packed[1], 1, n_probes=3, block_size=20)
+        self.assertEqual(list(probes.size()), [3, 2, N])
+
+        margins = torch.mm(sim.hyperplanes.get(D, bands, rows)[1], X.t()).abs()
+        home = unpack_signature(packed[1:], rows)[0]
+        for probe, flipped_row in zip(probes, torch.topk(margins, 3, dim=0, largest=False)[1]):
+            probe_signature = unpack_signature(probe[None], rows)[0]
+            # (node, row) of every flipped bit, one per node
+            differing = (probe_signature != home).t().nonzero()
+
+            self.assertTrue(torch.equal(differing[:, 0], torch.arange(N)))
+            self.assertTrue(torch.equal(differing[:, 1], flipped_row))
+
+    def test_streamed_signature_matches_signature(self):
+        N, D = 1000, 16
+        bands, rows = 4, 70
+
+        X = torch.randn((N, D))
+        sim = CosineSimilarity(bands, rows, seed=0)
+        packed = sim.packed_signature(X)
+
+        with tempfile.TemporaryDirectory() as directory:
+            np.save(join(directory, 'emb.npy'), X.numpy())
+            embeddings = load_embeddings(join(directory, 'emb.npy'))
+            out = open_signature(join(directory, 'sig.npy'), bands, rows, N)
+            sim.packed_signature(embeddings, block_size=300, out=out)
+            del out
+
+            self.assertTrue(torch.equal(load_signature(join(directory, 'sig.npy')), packed))
+
+            torch.save(X, join(directory, 'emb.pt'))
+            embeddings = load_embeddings(join(directory, 'emb.pt'))
+            self.assertEqual(embeddings.device, torch.device('cpu'))
+            self.assertTrue(torch.equal(sim.packed_signature(embeddings, block_size=300), packed))
+
+
+class TestDotProductSimilarity(unittest.TestCase):
+
+    def test_streamed_signature_matches_signature(self):
+        X = torch.randn((300, 8)) * torch.rand((300, 1))
+        sim = DotProductSimilarity(4, 10, seed=0)
+
+        signature_matrix = sim.signature(X)
+        self.assertEqual(list(signature_matrix.size()), [4, 10, 300])
+        self.assertTrue(torch.equal(sim.packed_signature(X, block_size=70), pack_signature(signature_matrix)))
+
+    def test_fitted_metric_hashes_subsets_alike(self):
+        X = torch.randn((300, 8)) * torch.linspace(0.1, 1, 300)[:, None]
+        sim = DotProductSimilarity(4, 10, seed=0)
+        fitted = sim.fit(X, block_size=70)
+
+        self.assertAlmostEqual(fitted.max_norm, float(X.norm(dim=1).max()), places=5)
+        subset_signature = fitted.packed_signature(X[:100])
+        self.assertTrue(torch.equal(subset_signature, sim.packed_signature(X)[:, :, :100]))
+        self.assertEqual(fitted.with_shape(2, 10).max_norm, fitted.max_norm)
+
+    def test_decoder_matches_inner_product_decoder(self):
+        emb = torch.randn((400, 8)) * torch.rand((400, 1)) * 2
+        threshold = 4.0
+
+        dense = InnerProductDecoder().forward_all(emb, sigmoid=False)
+        dense.fill_diagonal_(-np.inf)
+        expected = set(map(tuple, (dense >= threshold).nonzero().tolist()))
+
+        adj = LSHDecoder(bands=16, rows=2, sim_thresh=threshold, metric=DotProductSimilarity, seed=0)(emb).coalesce()
+        pairs = set(map(tuple, adj.indices().t().tolist()))
+
+        self.assertTrue(pairs <= expected)
+        self.assertTrue(len(pairs) >= 0.95 * len(expected))
+        self.assertTrue(torch.allclose(adj.values(), dense[adj.indices()[0], adj.indices()[1]], atol=1e-5))
+
+
+class TestEuclideanDistance(unittest.TestCase):
+
+    def test_streamed_signature_matches_signature(self):
+        X = torch.randn((300, 8))
+        sim = EuclideanDistance(4, 10, w=0.5, seed=0)
+
+        signature_matrix = sim.signature(X)
+        self.assertEqual(list(signature_matrix.size()), [4, 10, 300])
+        self.assertEqual(signature_matrix.dtype, torch.long)
+        self.assertTrue(torch.equal(sim.packed_signature(X, block_size=70), signature_matrix))
+
+    def test_probe_keys_move_to_neighboring_bucket(self):
+        X = torch.randn((200, 8))
+        sim = EuclideanDistance(3, 6, seed=0)
+
+        keys = sim.packed_signature(X)
+        probes = sim.probe_keys(X, keys[1], 1, 3)
+        self.assertEqual(list(probes.size()), [3, 6, 200])
+
+        steps = probes - keys[1]
+        self.assertTrue(((steps != 0).sum(dim=1) == 1).all())
+        self.assertTrue((steps.abs().sum(dim=1) == 1).all())
+
+    def test_decoder_matches_euclidean_distance_decoder(self):
+        emb = torch.randn((500, 8))
+        threshold = 0.4
+
+        dense = EuclideanDistanceDecoder().forward_all(emb, sigmoid=False)
+        dense.fill_diagonal_(-np.inf)
+        expected = set(map(tuple, (dense >= threshold).nonzero().tolist()))
+
+        metric = lambda bands, rows, seed: EuclideanDistance(bands, rows, w=1.0, seed=seed)
+        adj = LSHDecoder(bands=16, rows=3, sim_thresh=threshold, metric=metric, seed=0)(emb).coalesce()
+        pairs = set(map(tuple, adj.indices().t().tolist()))
+
+        self.assertTrue(pairs <= expected)
+        self.assertTrue(len(pairs) >= 0.95 * len(expected))
+        self.assertTrue(torch.allclose(adj.values(), dense[adj.indices()[0], adj.indices()[1]], atol=1e-5))
+
+
+class TestBucketing(unittest.TestCase):
+
+    def test_pack_signature(self):
+        bands, rows, N = 3, 70, 50
+        signature = torch.randint(0, 2, (bands, rows, N)) * 2 - 1
+        signature[:, :, 1] = signature[:, :, 0]
+
+        packed = pack_signature(signature)
+        self.assertEqual(list(packed.size()), [bands, 2, N])
+
+        # Equal columns must get equal keys, different columns different keys
+        for band in range(bands):
+            for i in range(N):
+                for j in range(N):
+                    same_column = torch.equal(signature[band, :, i], signature[band, :, j])
+                    same_key = torch.equal(packed[band, :, i], packed[band, :, j])
+                    self.assertEqual(same_column, same_key)
+
+    def test_bucket_band_matches_sequential_scan(self):
+        N = 200
+        keys = torch.randint(0, 7, (1, N))
+
+        expected = {}
+        for i in range(N):
+            expected.setdefault(keys[0, i].item(), []).append(i)
+
+        nodes, offsets, sizes = bucket_band(keys)
+        buckets = [nodes[o:o + s].tolist() for o, s in zip(offsets.tolist(), sizes.tolist())]
+
+        self.assertEqual(buckets, list(expected.values()))
+
+    def test_bucket_pairs(self):
+        keys = torch.randint(0, 5, (1, 60))
+        nodes, offsets, sizes = bucket_band(keys)
+
+        rows, cols = bucket_pairs(nodes, offsets, sizes)
+
+        expected = {(i, j) for i in range(60) for j in range(i + 1, 60) if keys[0, i] == keys[0, j]}
+        self.assertTrue((rows < cols).all())
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(set(zip(rows.tolist(), cols.tolist())), expected)
+
+    def test_tile_pairs(self):
+        members = torch.tensor([2, 3, 5, 8, 13, 21, 34])
+        tiles = list(tile_pairs(members, batch_size=10))
+
+        rows = torch.cat([tile[0] for tile in tiles])
+        cols = torch.cat([tile[1] for tile in tiles])
+        expected = {(i, j) for i in members.tolist() for j in members.tolist() if i < j}
+
+        self.assertTrue(len(tiles) > 1)
+        self.assertTrue(all(len(tile[0]) <= 10 + len(members) for tile in tiles))
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(set(zip(rows.tolist(), cols.tolist())), expected)
+
+
+class TestPairAccumulator(unittest.TestCase):
+
+    def test_matches_concatenation(self):
+        pairs = PairAccumulator(capacity=4)
+        chunks = [torch.randint(0, 50, (k, 2)) for k in [0, 3, 10, 1, 40]]
+        values = [torch.rand(len(chunk)) for chunk in chunks]
+
+        for chunk, value in zip(chunks, values):
+            pairs.append(chunk[:, 0], chunk[:, 1], value)
+
+        matrix = pairs.to_sparse(50)
+        self.assertEqual(len(pairs), 54)
+        self.assertTrue(torch.equal(matrix._indices(), torch.cat(chunks).t()))
+        self.assertTrue(torch.equal(matrix._values(), torch.cat(values)))
+
+    def test_empty(self):
+        matrix = PairAccumulator().to_sparse(10)
+        self.assertEqual(matrix._nnz(), 0)
+        self.assertEqual(matrix.size(), torch.Size([10, 10]))
+
+    def test_csr_matches_coo(self):
+        pairs = PairAccumulator()
+        pairs.append(torch.tensor([3, 0, 1, 0]), torch.tensor([4, 2, 3, 1]), torch.tensor([0.5, 0.6, 0.7, 0.8]))
+
+        coo = pairs.to_sparse(6, symmetric=True).to_dense()
+        csr = pairs.to_csr(6, symmetric=True)
+        self.assertEqual(csr.crow_indices().dtype, torch.int32)
+        self.assertEqual(csr.col_indices().dtype, torch.int32)
+        self.assertTrue(torch.equal(csr.to_dense(), coo))
+
+        half = pairs.to_csr(6, symmetric=True, dtype=torch.float16)
+        self.assertEqual(half.values().dtype, torch.float16)
+        self.assertTrue(torch.allclose(half.to_dense().float(), coo, atol=1e-3))
+
+        matrix = pairs.to_scipy(6, symmetric=True, dtype=torch.bool)
+        self.assertEqual(matrix.indices.dtype, np.int32)
+        self.assertTrue(np.array_equal(matrix.toarray(), coo.numpy() > 0))
+
+    def test_flush_values_that_require_grad(self):
+        pairs = PairAccumulator()
+        pairs.append(torch.tensor([0, 1]), torch.tensor([2, 3]), torch.tensor([0.5, 0.6], requires_grad=True) * 2)
+
+        self.assertFalse(pairs.to_sparse(4).requires_grad)
+        self.assertFalse(pairs.to_csr(4).requires_grad)
+        matrix = pairs.to_scipy(4, symmetric=True)
+        self.assertTrue(np.allclose(matrix[0, 2], 1.0))
+        self.assertTrue(np.allclose(matrix[3, 1], 1.2))
+
+    def test_merge_keeps_first_copy(self):
+        first, second = PairAccumulator(), PairAccumulator()
+        first.append(torch.tensor([0, 1]), torch.tensor([2, 3]), torch.tensor([0.5, 0.6]))
+        second.append(torch.tensor([1, 4]), torch.tensor([3, 5]), torch.tensor([0.7, 0.8]))
+
+        matrix = PairAccumulator.merge([first, second], 10).to_sparse(10).coalesce()
+        self.assertEqual(matrix.indices().t().tolist(), [[0, 2], [1, 3], [4, 5]])
+        self.assertTrue(torch.allclose(matrix.values(), torch.tensor([0.5, 0.6, 0.8])))
+
+
+class TestPairKeySet(unittest.TestCase):
+
+    def test_contains(self):
+        seen = PairKeySet(100)
+        self.assertFalse(seen.contains(torch.tensor([5, 7])).any())
+
+        seen.update(seen.encode(torch.tensor([1, 2, 1]), torch.tensor([3, 4, 3])))
+        self.assertEqual(len(seen), 2)
+        seen.update(seen.encode(torch.tensor([5]), torch.tensor([6])))
+        self.assertEqual(len(seen), 3)
+
+        keys = seen.encode(torch.tensor([1, 2, 3, 99, 5]), torch.tensor([3, 4, 1, 99, 6]))
+        self.assertEqual(seen.contains(keys).tolist(), [True, True, False, False, True])
+
 
 class TestLSHDecoder(unittest.TestCase):
 
@@ -58,6 +327,133 @@ class TestLSHDecoder(unittest.TestCase):
         self.assertTrue(len(indices) == 2)
         self.assertTrue([0, 3] in indices and [3, 0] in indices)
 
+    def test_pairs_found_in_several_bands_are_not_summed(self):
+        emb = torch.randn((200, 4))
+        emb[1] = emb[0] + 0.01
+
+        dec = LSHDecoder(bands=16, rows=2, sim_thresh=0.5, verbose=False)
+        adj = dec(emb).coalesce()
+        rows, cols = adj.indices()
+
+        self.assertTrue(torch.allclose(adj.values(), F.cosine_similarity(emb[rows], emb[cols], dim=1), atol=1e-6))
+        self.assertTrue(torch.equal(adj.to_dense(), adj.to_dense().t()))
+
+    def test_batch_memory_does_not_change_result(self):
+        emb = torch.randn((500, 8))
+
+        adj = LSHDecoder(bands=4, rows=3, sim_thresh=0.3, seed=0)(emb).coalesce()
+        adj_small_batches = LSHDecoder(bands=4, rows=3, sim_thresh=0.3, seed=0, batch_memory=1000)(emb).coalesce()
+
+        self.assertTrue(torch.equal(adj.indices(), adj_small_batches.indices()))
+        self.assertTrue(torch.allclose(adj.values(), adj_small_batches.values()))
+
+    def test_oversized_buckets(self):
+        emb = torch.randn((300, 8))
+
+        dec = LSHDecoder(bands=2, rows=1, sim_thresh=0.3, seed=0)
+        adj = dec(emb).coalesce()
+        self.assertEqual(dec.bucket_stats['tiled'], 0)
+
+        # Tiling gives exactly the same pairs
+        tiled_dec = LSHDecoder(bands=2, rows=1, sim_thresh=0.3, seed=0, max_bucket_size=50)
+        tiled_adj = tiled_dec(emb).coalesce()
+        self.assertEqual(tiled_dec.bucket_stats['tiled'], 4)
+        self.assertTrue(torch.equal(adj.indices(), tiled_adj.indices()))
+
+        # Splitting can only lose pairs
+        split_dec = LSHDecoder(bands=2, rows=1, sim_thresh=0.3, seed=0, max_bucket_size=50, oversized_buckets='split')
+        split_adj = split_dec(emb).coalesce()
+        self.assertEqual(split_dec.bucket_stats['split'], 4)
+        self.assertTrue(split_dec.bucket_stats['regular'] > 0)
+
+        all_pairs = set(map(tuple, adj.indices().t().tolist()))
+        self.assertTrue(set(map(tuple, split_adj.indices().t().tolist())) <= all_pairs)
+
+    def test_seeded_hyperplanes_are_saved_with_decoder(self):
+        emb = torch.randn((500, 8))
+
+        dec = LSHDecoder(bands=4, rows=3, sim_thresh=0.3, seed=1)
+        adj = dec(emb).coalesce()
+
+        # Same seed gives the same hash functions, and so do hyperplanes restored from the state dict
+        same_seed_adj = LSHDecoder(bands=4, rows=3, sim_thresh=0.3, seed=1)(emb).coalesce()
+        self.assertTrue(torch.equal(adj.indices(), same_seed_adj.indices()))
+
+        with tempfile.TemporaryDirectory() as directory:
+            torch.save(dec.state_dict(), join(directory, 'decoder.pt'))
+
+            restored = LSHDecoder(bands=4, rows=3, sim_thresh=0.3, seed=2)
+            restored.load_state_dict(torch.load(join(directory, 'decoder.pt')))
+
+        self.assertTrue(torch.equal(adj.indices(), restored(emb).coalesce().indices()))
+
+    def test_multi_probe_finds_more_pairs(self):
+        emb = torch.randn((500, 8))
+
+        dec = LSHDecoder(bands=2, rows=6, sim_thresh=0.5, seed=0)
+        adj = dec(emb).coalesce()
+        probe_dec = LSHDecoder(bands=2, rows=6, sim_thresh=0.5, seed=0, n_probes=2, batch_memory=10000)
+        probe_adj = probe_dec(emb).coalesce()
+
+        pairs = set(map(tuple, adj.indices().t().tolist()))
+        probe_pairs = set(map(tuple, probe_adj.indices().t().tolist()))
+
+        self.assertTrue(pairs < probe_pairs)
+        self.assertTrue(probe_dec.bucket_stats['probed'] > 0)
+        self.assertTrue(probe_dec.n_verified > dec.n_verified)
+
+        # Every pair is contained once per direction
+        self.assertEqual(probe_adj._nnz(), len(probe_pairs))
+        self.assertTrue(torch.allclose(probe_adj.values(), F.cosine_similarity(
+            emb[probe_adj.indices()[0]], emb[probe_adj.indices()[1]], dim=1), atol=1e-6))
+
+    def test_multi_probe_empty_graph(self):
+        adj = LSHDecoder(bands=2, rows=6, seed=0, n_probes=2)(torch.randn((0, 8)))
+        self.assertEqual(list(adj.size()), [0, 0])
+        self.assertEqual(adj._nnz(), 0)
+
+    def test_parallel_bands_match_sequential(self):
+        emb = torch.randn((500, 8))
+
+        dec = LSHDecoder(bands=5, rows=4, sim_thresh=0.5, seed=0, n_probes=1)
+        adj = dec(emb).coalesce()
+        parallel_dec = LSHDecoder(bands=5, rows=4, sim_thresh=0.5, seed=0, n_probes=1, n_jobs=3)
+        parallel_adj = parallel_dec(emb).coalesce()
+
+        self.assertTrue(torch.equal(adj.indices(), parallel_adj.indices()))
+        self.assertTrue(torch.allclose(adj.values(), parallel_adj.values()))
+        self.assertEqual(dec.bucket_stats, parallel_dec.bucket_stats)
+
+    def test_nearest_neighbors_rank_all_candidates(self):
+        emb = torch.randn((300, 8))
+        k = 5
+
+        # A bound above every similarity never stops early, so all candidates are ranked
+        indices, similarities = LSHDecoder(bands=4, rows=2, sim_thresh=2.0, seed=0, k=k)(emb)
+        candidates = LSHDecoder(bands=4, rows=2, assure_correctness=False, seed=0)(emb).coalesce()
+
+        self.assertEqual(list(indices.size()), [300, k])
+        expected = torch.full((300, 300), -np.inf)
+        expected[candidates.indices()[0], candidates.indices()[1]] = candidates.values()
+        expected_similarities = torch.topk(expected, k, dim=1)[0]
+
+        self.assertTrue(torch.allclose(similarities, expected_similarities, atol=1e-6))
+
+        found = indices >= 0
+        neighbor_similarities = F.cosine_similarity(emb[:, None], emb[indices.clamp(min=0)], dim=2)
+        self.assertTrue(torch.allclose(similarities[found], neighbor_similarities[found], atol=1e-6))
+        self.assertFalse((indices == torch.arange(300)[:, None]).any())
+
+    def test_nearest_neighbors_stop_early(self):
+        emb = torch.randn((300, 8))
+
+        dec = LSHDecoder(bands=8, rows=1, sim_thresh=-1.0, seed=0, k=3, verbose=True)
+        indices, similarities = dec(emb)
+
+        # Every node has three candidates after the first band already
+        self.assertTrue((indices >= 0).all())
+        self.assertEqual(dec.bucket_stats['regular'], 2)
+
     def test_does_not_fail_on_large_input(self):
         emb = np.random.normal(size=(100000, 128)).astype(np.float32)
         emb_tensor = torch.tensor(emb)
@@ -0,0 +1,64 @@
+import sys
+import unittest
+from os.path import dirname, abspath
+
+import numpy as np
+import torch
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from graph.torch_lsh import CosineSimilarity, DotProductSimilarity, LSHDecoder
+from graph.tuning import N_BINS, s_curve, sample_collisions, tune_lsh
+
+
+class TestTuning(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        torch.manual_seed(0)
+        centers = torch.randn((50, 16))
+        self.embeddings = centers[torch.randint(0, 50, (2000,))] + 0.5 * torch.randn((2000, 16))
+
+    def test_s_curve(self):
+        self.assertAlmostEqual(s_curve(0.5, 1, 1), 0.5)
+        self.assertAlmostEqual(s_curve(0.5, 2, 2), 1 - 0.75 ** 2)
+        self.assertTrue(np.all(np.diff(s_curve(np.linspace(0, 1, 11), 8, 4)) >= 0))
+
+    def test_predicted_recall_is_reached(self):
+        threshold = 0.8
+        best, predictions = tune_lsh(self.embeddings, threshold, target_recall=0.9, bands_grid=range(1, 33),
+                                     rows_grid=range(1, 33), verbose=False)
+        self.assertEqual(len(predictions), 32 * 32)
+        self.assertTrue(best['recall'] >= 0.9)
+
+        decoder = LSHDecoder(bands=best['bands'], rows=best['rows'], sim_thresh=threshold, seed=0)
+        adj = decoder(self.embeddings).coalesce()
+
+        similarities = CosineSimilarity(1, 1).pairwise_sim(self.embeddings)
+        similarities.fill_diagonal_(-1)
+        recall = adj._nnz() / int((similarities >= threshold).sum())
+        self.assertAlmostEqual(recall, best['recall'], delta=0.05)
+
+    def test_dot_product_sample_lifted_by_all_embeddings(self):
+        embeddings = self.embeddings * torch.linspace(0.1, 1, 2000)[:, None]
+        metric = DotProductSimilarity(1, 1, seed=0)
+
+        np.random.seed(1)
+        _, all_pairs, _ = sample_collisions(embeddings, 1.0, metric, sample_size=200)
+        np.random.seed(1)
+        sample_ix = np.random.choice(np.arange(2000), size=200, replace=False)
+
+        # Probabilities of the sampled pairs if all embeddings are lifted at once
+        probabilities = metric.pairwise_collision_probability(embeddings)[sample_ix][:, sample_ix]
+        upper = torch.triu_indices(200, 200, offset=1)
+        expected = np.histogram(probabilities[upper[0], upper[1]].numpy(), bins=np.linspace(0, 1, N_BINS + 1))[0]
+        # Allow a few pairs to end up in a neighboring bin through rounding
+        self.assertTrue(np.abs(all_pairs * upper.size(1) - expected).sum() <= 10)
+
+    def test_unreachable_threshold(self):
+        with self.assertRaises(ValueError):
+            tune_lsh(self.embeddings, 1.5, verbose=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import sys
+import unittest
+from types import SimpleNamespace
+from os.path import dirname, abspath
+
+import numpy as np
+import torch
+
+sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+from graph.torch_lsh import LSHDecoder
+from graph.modules import CosineSimDecoder
+from graph.utils import dense_precision_recall, edge_keys, evaluate_edges, pr_auc, sparse_edges, \
+    sparse_precision_recall, sparse_precision_recall_curve, sparse_size, sparse_v_dense_precision_recall, \
+    streaming_precision_recall, streaming_precision_recall_curve, threshold_counts
+
+
+class TestSparseOutputs(unittest.TestCase):
+
+    def setUp(self):
+        self.embeddings = torch.randn((300, 8))
+
+    def test_edges_match_across_formats(self):
+        edges = [set(map(tuple, sparse_edges(LSHDecoder(bands=4, rows=4, sim_thresh=0.5, seed=0, output=output,
+                                                        value_dtype=value_dtype)(self.embeddings)).tolist()))
+                 for output, value_dtype in [('coo', None), ('csr', torch.float16), ('scipy', torch.bool)]]
+
+        self.assertTrue(len(edges[0]) > 0)
+        self.assertEqual(edges[0], edges[1])
+        self.assertEqual(edges[0], edges[2])
+
+    def test_csr_is_smaller(self):
+        coo = LSHDecoder(bands=4, rows=4, sim_thresh=0.5, seed=0)(self.embeddings)
+        csr = LSHDecoder(bands=4, rows=4, sim_thresh=0.5, seed=0, output='csr', value_dtype=torch.float16)(
+            self.embeddings)
+
+        nnz = coo._nnz()
+        self.assertAlmostEqual(sparse_size(coo), nnz * (2 * 8 + 4) / 10 ** 6)
+        self.assertAlmostEqual(sparse_size(csr), (nnz * (4 + 2) + 301 * 4) / 10 ** 6)
+
+
+class TestEvaluateEdges(unittest.TestCase):
+
+    def test_matches_sets_of_edges(self):
+        pred = np.random.randint(0, 100, (2000, 2))
+        true = np.concatenate((pred[:500], np.random.randint(0, 100, (1000, 2))))
+
+        pred_set, true_set = set(map(tuple, pred.tolist())), set(map(tuple, true.tolist()))
+        n_found = len(pred_set & true_set)
+
+        precision, recall = evaluate_edges(pred, true, verbose=False)
+        self.assertAlmostEqual(precision, n_found / len(pred_set))
+        self.assertAlmostEqual(recall, n_found / len(true_set))
+        self.assertEqual(len(edge_keys(pred)), len(pred_set))
+
+    def test_no_predictions(self):
+        self.assertEqual(evaluate_edges(np.zeros((0, 2)), np.ones((5, 2)), verbose=False), (0, 0))
+
+    def test_sparse_v_dense(self):
+        dense = torch.rand((50, 50))
+        sparse = (dense * (dense > 0.8)).to_sparse()
+
+        self.assertEqual(sparse_v_dense_precision_recall(dense, sparse, 0.8, verbose=False), (1.0, 1.0))
+        self.assertEqual(sparse_v_dense_precision_recall(dense, sparse, 0.9, verbose=False)[1], 1.0)
+
+
+class TestStreamingPrecisionRecall(unittest.TestCase):
+
+    def setUp(self):
+        edges = torch.randint(0, 400, (2, 3000))
+        self.data = SimpleNamespace(val_pos_edge_index=edges[:, :100], test_pos_edge_index=edges[:, 100:200],
+                                    train_pos_edge_index=edges[:, 200:])
+        self.z = torch.randn((400, 8))
+        self.decoder = CosineSimDecoder()
+
+    def test_matches_dense(self):
+        expected = dense_precision_recall(self.data, self.decoder.forward_all(self.z, sigmoid=False), 0.7,
+                                          verbose=False)
+        for block_size in [64, 400, 1000]:
+            self.assertEqual(streaming_precision_recall(self.data, self.decoder, self.z, 0.7, block_size=block_size,
+                                                        verbose=False), expected)
+
+    def test_curve_matches_dense(self):
+        dense = self.decoder.forward_all(self.z, sigmoid=False)
+        thresholds = [0.5, 0.7, 0.9]
+
+        precision, recall = streaming_precision_recall_curve(self.data, self.decoder, self.z, thresholds,
+                                                             block_size=64, verbose=False)
+        for i, threshold in enumerate(thresholds):
+            self.assertEqual((precision[i], recall[i]),
+                             dense_precision_recall(self.data, dense, threshold, verbose=False))
+
+    def test_curve_matches_lsh_graphs(self):
+        thresholds = [0.5, 0.7, 0.9]
+        lsh = LSHDecoder(bands=4, rows=4, sim_thresh=thresholds[0], seed=0, output='csr', value_dtype=torch.float32)
+
+        precision, recall = sparse_precision_recall_curve(self.data, lsh(self.z), thresholds, verbose=False)
+        for i, threshold in enumerate(thresholds):
+            expected = sparse_precision_recall(self.data, LSHDecoder(bands=4, rows=4, sim_thresh=threshold, seed=0)(
+                self.z), verbose=False)
+            self.assertTrue(np.allclose((precision[i], recall[i]), expected))
+
+
+class TestPrecisionRecallCurve(unittest.TestCase):
+
+    def test_threshold_counts(self):
+        values = torch.rand(1000)
+        thresholds = torch.tensor([0.1, 0.5, 0.5, 0.9])
+
+        expected = [int((values > threshold).sum()) for threshold in thresholds]
+        self.assertEqual(threshold_counts(values, thresholds).tolist(), expected)
+
+    def test_pr_auc(self):
+        self.assertAlmostEqual(pr_auc(np.array([1.0, 1.0]), np.array([1.0, 0.0])), 1.0)
+        self.assertAlmostEqual(pr_auc(np.array([0.5, 1.0, 0.0]), np.array([1.0, 0.5, 0.0])), 0.625)
+
+
+if __name__ == '__main__':
+    unittest.main()
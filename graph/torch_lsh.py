@@ -1,16 +1,221 @@
+import itertools
+import math
 import os.path as path
 import sys
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import scipy.sparse as sp
 import torch
 import torch.nn.functional as F
-from torch.distributions import MultivariateNormal
 from tqdm import tqdm
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
+# Number of hyperplane bits packed into one int64 key word
+WORD_BITS = 64
+
+
+def as_tensor(array):
+    """
+    :return: array as a tensor, copying it if it is a (memory-mapped) numpy array
+    """
+    return array if isinstance(array, torch.Tensor) else torch.tensor(np.asarray(array))
+
+
+def gather_rows(embeddings, index: torch.Tensor):
+    """
+    :return: the rows of embeddings at index as a tensor on the device of index
+    """
+    if isinstance(embeddings, torch.Tensor):
+        return embeddings[index]
+
+    return as_tensor(embeddings[index.cpu().numpy()]).to(index.device)
+
+
+def load_embeddings(file_path: str):
+    """
+    Opens embeddings stored with np.save (.npy) or torch.save (.pt) memory-mapped, so that they can be hashed in
+    blocks without reading the whole file into memory.
+    :return: memory-mapped numpy array or tensor of shape (n_samples, D)
+    """
+    if file_path.endswith('.npy'):
+        return np.load(file_path, mmap_mode='r')
+
+    # Tensors saved from the GPU would otherwise be restored onto it instead of being memory-mapped
+    return torch.load(file_path, mmap=True, map_location='cpu').detach()
+
+
+def open_signature(file_path: str, bands: int, rows: int, n_samples: int):
+    """
+    Creates a memory-mapped .npy file for a bit-packed signature matrix that packed_signature can write to
+    incrementally via its out argument.
+    :return: int64 tensor with shape (bands, words, n_samples) backed by the file
+    """
+    signature = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.int64,
+                                          shape=(bands, n_words(rows), n_samples))
+    return torch.from_numpy(signature)
+
+
+def load_signature(file_path: str):
+    """
+    Opens a bit-packed signature matrix written by open_signature or np.save memory-mapped.
+    :return: int64 tensor with shape (bands, words, n_samples)
+    """
+    # Copy-on-write keeps the file untouched while still giving a writable tensor
+    return torch.from_numpy(np.load(file_path, mmap_mode='c'))
+
+
+def n_words(rows: int):
+    """
+    :return: number of int64 words needed to store one bit for each of the rows hyperplanes of a band
+    """
+    return max(1, (rows + WORD_BITS - 1) // WORD_BITS)
+
+
+def pack_signature(signature_matrix: torch.Tensor):
+    """
+    Packs the +-1 rows of every band into integer keys, one bit per hyperplane.
+    :param signature_matrix: signature matrix with shape (bands, rows, n_samples)
+    :return: int64 tensor with shape (bands, words, n_samples), where words = ceil(rows / 64)
+    """
+    bands, rows, N = signature_matrix.shape
+
+    packed = torch.zeros((bands, n_words(rows), N), dtype=torch.long, device=signature_matrix.device)
+
+    # Loop over the hyperplanes instead of materializing a (bands, rows, N) int64 tensor
+    for row in range(rows):
+        word, bit = divmod(row, WORD_BITS)
+        packed[:, word] |= (signature_matrix[:, row] > 0).long() << bit
+
+    return packed
+
+
+def unpack_signature(packed_signature: torch.Tensor, rows: int):
+    """
+    Inverse of pack_signature.
+    :param packed_signature: int64 tensor with shape (bands, words, n_samples)
+    :param rows: number of rows per band that were packed
+    :return: signature matrix of +-1 values with shape (bands, rows, n_samples)
+    """
+    bands, words, N = packed_signature.shape
+    assert words == n_words(rows), "Number of rows does not match the packed signature"
+
+    signature_matrix = torch.empty((bands, rows, N), dtype=torch.int, device=packed_signature.device)
+
+    for row in range(rows):
+        word, bit = divmod(row, WORD_BITS)
+        signature_matrix[:, row] = ((packed_signature[:, word] >> bit) & 1).int() * 2 - 1
+
+    return signature_matrix
+
+
+def bucket_band(band_keys: torch.Tensor):
+    """
+    Groups all nodes of one band into buckets of identical keys using sort/unique operations on the device.
+    :param band_keys: packed keys of a single band with shape (words, n_samples)
+    :return: (nodes, offsets, sizes) where nodes[offsets[k]:offsets[k] + sizes[k]] are the ascending node indices
+     of the k-th bucket. Buckets are ordered by their first node, i.e. in the order they are first encountered.
+    """
+    words, N = band_keys.shape
+
+    if words == 1:
+        _, bucket_ids, sizes = torch.unique(band_keys[0], return_inverse=True, return_counts=True)
+    else:
+        _, bucket_ids, sizes = torch.unique(band_keys.t(), dim=0, return_inverse=True, return_counts=True)
+
+    # Stable sort keeps the nodes of each bucket in ascending order
+    nodes = torch.sort(bucket_ids, stable=True)[1]
+    offsets = torch.cumsum(sizes, dim=0) - sizes
+
+    # Reorder buckets by their first node to preserve the order of a sequential scan over all nodes
+    order = torch.argsort(nodes[offsets])
+
+    return nodes, offsets[order], sizes[order]
+
+
+def bucket_pairs(nodes: torch.Tensor, offsets: torch.Tensor, sizes: torch.Tensor):
+    """
+    Enumerates every unordered pair of nodes that share a bucket, for all given buckets at once.
+    :param nodes: node indices grouped by bucket and ascending within each bucket, see bucket_band
+    :param offsets: start of each bucket in nodes
+    :param sizes: number of nodes in each bucket
+    :return: (rows, cols) LongTensors with rows < cols
+    """
+    device = nodes.device
+
+    # Position in nodes and number of later bucket members for every member of the given buckets
+    member_bucket = torch.repeat_interleave(torch.arange(sizes.size(0), device=device), sizes)
+    member_rank = torch.arange(member_bucket.size(0), device=device) - (torch.cumsum(sizes, 0) - sizes)[member_bucket]
+    member_position = offsets[member_bucket] + member_rank
+    n_partners = sizes[member_bucket] - member_rank - 1
+
+    row_position, col_position = _pair_with_later(member_position, n_partners)
+    return nodes[row_position], nodes[col_position]
+
+
+def tile_pairs(members: torch.Tensor, batch_size: int):
+    """
+    Enumerates every unordered pair of a single large bucket in tiles, so that never more than about batch_size
+    pairs are held at once.
+    :param members: ascending node indices of the bucket
+    :return: generator of (rows, cols) LongTensors with rows < cols
+    """
+    size = members.size(0)
+    rows_per_tile = max(1, batch_size // size)
+
+    for start in range(0, size - 1, rows_per_tile):
+        member_position = torch.arange(start, min(start + rows_per_tile, size - 1), device=members.device)
+        row_position, col_position = _pair_with_later(member_position, size - member_position - 1)
+        yield members[row_position], members[col_position]
+
+
+def _pair_with_later(member_position, n_partners):
+    """
+    Pairs the member at every given position with the n_partners members directly following it.
+    :return: (row_position, col_position) LongTensors
+    """
+    row_position = torch.repeat_interleave(member_position, n_partners)
+    partner_rank = torch.arange(row_position.size(0), device=row_position.device) - torch.repeat_interleave(
+        torch.cumsum(n_partners, 0) - n_partners, n_partners)
+
+    return row_position, row_position + 1 + partner_rank
+
+
+class HyperplaneBank(object):
+    """
+    Seeded store of random hyperplanes drawn from a standard normal distribution with torch.randn.
+    Hyperplanes are drawn once per (D, bands, rows) and reused afterwards, so that repeated signatures of the same
+    metric use the same hash functions.
+    """
+
+    def __init__(self, seed: int = None):
+        # Without a seed, take one from the global RNG so that torch.manual_seed still makes runs reproducible
+        self.seed = seed if seed is not None else int(torch.randint(2 ** 62, (1,)))
+        self.planes = {}
+
+    def get(self, D: int, bands: int, rows: int, device=None):
+        """
+        :return: hyperplanes of shape (bands, rows, D)
+        """
+        key = (D, bands, rows)
+
+        if key not in self.planes:
+            # Different shapes get independent hyperplanes instead of prefixes of the same random stream
+            generator = torch.Generator().manual_seed(hash((self.seed,) + key) % 2 ** 62)
+            self.planes[key] = torch.randn((bands, rows, D), generator=generator)
+
+        return self.planes[key].to(device)
+
+    def state_dict(self):
+        return {'seed': self.seed, 'planes': dict(self.planes)}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.planes = dict(state_dict['planes'])
+
 
 class LSHDistanceMetric(ABC):
 
@@ -22,6 +227,10 @@ class LSHDistanceMetric(ABC):
     def pairwise_sim(embeddings):
         pass
 
+    @abstractmethod
+    def paired_sim(v1, v2):
+        pass
+
     @abstractmethod
     def dist(v1, v2):
         pass
@@ -30,13 +239,62 @@ class LSHDistanceMetric(ABC):
     def signature(X):
         pass
 
+    def key_words(self):
+        """
+        :return: number of int64 words of a packed bucket key of one band
+        """
+        return n_words(self.rows)
+
+    def with_shape(self, bands: int, rows: int):
+        """
+        :return: metric of the same kind with a different number of bands and rows sharing the hyperplane bank
+        """
+        return type(self)(bands, rows, hyperplanes=self.hyperplanes)
+
+    def fit(self, X, block_size: int = None):
+        """
+        Fixes everything the hashing derives from the embeddings, so that subsets of X such as shards or samples are
+        hashed exactly like they are as part of X.
+        :return: metric to hash the subsets of X with
+        """
+        return self
+
+    def pairwise_collision_probability(self, embeddings):
+        """
+        :return: (n_samples, n_samples) probabilities that two nodes agree in a single row of the signature
+        """
+        raise NotImplementedError(f"Collision probabilities are not implemented for {type(self).__name__}")
+
+    def probe_keys(self, X, band_keys: torch.Tensor, band: int, n_probes: int, block_size: int = None):
+        """
+        :return: packed keys of n_probes neighboring buckets of one band with shape (n_probes, words, n_samples)
+        """
+        raise NotImplementedError(f"Multi-probe LSH is not implemented for {type(self).__name__}")
+
+    def packed_signature(self, X, block_size: int = None, out: torch.Tensor = None):
+        """
+        :return: bit-packed signature matrix with shape (bands, words, n_samples), see pack_signature
+        """
+        packed = pack_signature(self.signature(as_tensor(X)))
+
+        if out is None:
+            return packed
+
+        out[:] = packed
+        return out
+
 
 class CosineSimilarity(LSHDistanceMetric):
 
-    def __init__(self, bands: int, rows: int):
+    def __init__(self, bands: int, rows: int, seed: int = None, hyperplanes: HyperplaneBank = None):
+        """
+        :param seed: Seed for drawing the hyperplanes
+        :param hyperplanes: Existing hyperplane bank to share, takes precedence over seed
+        """
         super(CosineSimilarity, self).__init__()
         self.bands = bands
         self.rows = rows
+        self.hyperplanes = hyperplanes if hyperplanes is not None else HyperplaneBank(seed)
 
     def sim(self, v1, v2):
         return F.cosine_similarity(v1, v2, dim=0)
@@ -45,56 +303,515 @@ class CosineSimilarity(LSHDistanceMetric):
         embeddings = embeddings / torch.norm(embeddings, dim=1)[:, None]
         return torch.mm(embeddings, embeddings.t())
 
+    def paired_sim(self, v1, v2):
+        """
+        :return: similarity of every row in v1 with the same row in v2, shape (k,)
+        """
+        v1 = v1 / torch.norm(v1, dim=1)[:, None]
+        v2 = v2 / torch.norm(v2, dim=1)[:, None]
+        return (v1 * v2).sum(dim=1)
+
     def dist(self, v1, v2):
         return 1 - self.sim(v1, v2)
 
+    def pairwise_collision_probability(self, embeddings):
+        """
+        A random hyperplane separates two vectors with probability angle / pi.
+        """
+        D, transform = self._transform(embeddings)
+        embeddings = F.normalize(transform(embeddings), dim=1)
+        return 1 - torch.arccos(torch.clamp(torch.mm(embeddings, embeddings.t()), -1, 1)) / math.pi
+
+    def _transform(self, X, block_size: int = None):
+        """
+        Prepares hashing X block by block, see DotProductSimilarity.
+        :return: (dimension of the hashed vectors, function mapping a block of X to the vectors that are hashed)
+        """
+        return X.shape[1], lambda block: block
+
     def signature(self, X: torch.Tensor):
         """
         :return: signature matrix with shape (bands, rows, n_samples)
         """
         device = X.device
-        N, D = X.shape
+        N = X.shape[0]
 
-        distribution = MultivariateNormal(torch.zeros(D), torch.eye(D))
-        random_planes = distribution.sample((self.bands * self.rows,)).to(device)
+        D, transform = self._transform(X)
+        X = transform(X)
+        random_planes = self.hyperplanes.get(D, self.bands, self.rows, device).reshape(self.bands * self.rows, D)
 
         # signature_matrix is (b*r) x N
         signature_matrix = (torch.mm(random_planes, X.t()) >= 0).int() * 2 - 1
 
         return signature_matrix.reshape(self.bands, self.rows, N)
 
+    def packed_signature(self, X, block_size: int = None, out: torch.Tensor = None):
+        """
+        Computes the signature matrix directly in bit-packed form, one bit per hyperplane, streaming over blocks of
+        nodes so that only one block of X has to be in memory at a time.
+        :param X: Embeddings of shape (n_samples, D), either a tensor or a memory-mapped array from load_embeddings
+        :param block_size: Number of nodes to hash at once, all nodes if None
+        :param out: Optional int64 tensor of shape (bands, words, n_samples) that the keys are written to block by
+         block, e.g. a memory-mapped one from open_signature
+        :return: int64 tensor with shape (bands, words, n_samples), see pack_signature
+        """
+        device = X.device if isinstance(X, torch.Tensor) else torch.device('cpu')
+        N = X.shape[0]
 
-class DotProductSimilarity(LSHDistanceMetric):
+        D, transform = self._transform(X, block_size)
+        random_planes = self.hyperplanes.get(D, self.bands, self.rows, device)
 
-    def __init__(self, bands: int, rows: int):
-        super(DotProductSimilarity, self).__init__()
-        self.bands = bands
-        self.rows = rows
+        if out is None:
+            out = torch.zeros((self.bands, self.key_words(), N), dtype=torch.long, device=device)
+        assert list(out.shape) == [self.bands, self.key_words(), N], "out has the wrong shape"
+
+        block_size = block_size or max(N, 1)
+
+        for start in range(0, N, block_size):
+            block = transform(as_tensor(X[start:start + block_size]).to(device=device, dtype=random_planes.dtype))
+            packed = torch.zeros((self.bands, self.key_words(), block.size(0)), dtype=torch.long, device=device)
+
+            # Project one hyperplane of every band at a time, the (b*r) x N projection is never materialized
+            for row in range(self.rows):
+                word, bit = divmod(row, WORD_BITS)
+                packed[:, word] |= (torch.mm(random_planes[:, row], block.t()) >= 0).long() << bit
+
+            out[:, :, start:start + block.size(0)] = packed
+
+        return out
+
+    def probe_keys(self, X, band_keys: torch.Tensor, band: int, n_probes: int, block_size: int = None):
+        """
+        Keys of the neighboring buckets of one band for multi-probe LSH. The j-th probe of a node flips the bit of the
+        hyperplane with the j-th smallest margin |w.x|, i.e. the one the node is most likely to fall on the other side
+        of for a similar node.
+        :param X: Embeddings of shape (n_samples, D) that band_keys were computed from
+        :param band_keys: packed keys of the band with shape (words, n_samples)
+        :param block_size: Number of nodes to project at once, all nodes if None
+        :return: int64 tensor with shape (n_probes, words, n_samples)
+        """
+        device = band_keys.device
+        N = X.shape[0]
+        n_probes = min(n_probes, self.rows)
+
+        D, transform = self._transform(X, block_size)
+        random_planes = self.hyperplanes.get(D, self.bands, self.rows, device)[band]
+        probes = band_keys.unsqueeze(0).repeat(n_probes, 1, 1)
+
+        block_size = block_size or max(N, 1)
+
+        for start in range(0, N, block_size):
+            block = transform(as_tensor(X[start:start + block_size]).to(device=device, dtype=random_planes.dtype))
+            stop = start + block.size(0)
+
+            margins = torch.mm(random_planes, block.t()).abs()
+            flipped_rows = torch.topk(margins, n_probes, dim=0, largest=False)[1]
+
+            word, bit = flipped_rows // WORD_BITS, flipped_rows % WORD_BITS
+            for w in range(band_keys.size(0)):
+                probes[:, w, start:stop] ^= torch.where(word == w, torch.ones_like(bit) << bit, torch.zeros_like(bit))
+
+        return probes
+
+
+class DotProductSimilarity(CosineSimilarity):
+    """
+    Maximum inner product search reduced to cosine LSH: all vectors are scaled by the largest norm M and lifted onto
+    the unit sphere with an extra coordinate, x -> (x / M, sqrt(1 - ||x / M||^2)). The lifted vectors are hashed with
+    the hyperplanes of CosineSimilarity, while candidates are verified with the plain inner product.
+    """
+
+    def __init__(self, bands: int, rows: int, seed: int = None, hyperplanes: HyperplaneBank = None,
+                 max_norm: float = None):
+        """
+        :param max_norm: Norm M to scale by, the largest norm of the hashed vectors if not set. See fit
+        """
+        super(DotProductSimilarity, self).__init__(bands, rows, seed=seed, hyperplanes=hyperplanes)
+        self.max_norm = max_norm
 
     def sim(self, v1, v2):
         return v1.dot(v2)
 
+    def pairwise_sim(self, embeddings):
+        return torch.mm(embeddings, embeddings.t())
+
+    def paired_sim(self, v1, v2):
+        """
+        :return: inner product of every row in v1 with the same row in v2, shape (k,)
+        """
+        return (v1 * v2).sum(dim=1)
+
     def dist(self, v1, v2):
         raise NotImplementedError()
 
+    def with_shape(self, bands: int, rows: int):
+        return DotProductSimilarity(bands, rows, hyperplanes=self.hyperplanes, max_norm=self.max_norm)
+
+    def fit(self, X, block_size: int = None):
+        return DotProductSimilarity(self.bands, self.rows, hyperplanes=self.hyperplanes,
+                                    max_norm=self._max_norm(X, block_size))
+
+    def _max_norm(self, X, block_size: int = None):
+        N = X.shape[0]
+        block_size = block_size or max(N, 1)
+
+        # The largest norm needs one pass over all blocks before any of them can be lifted
+        return max((float(as_tensor(X[start:start + block_size]).float().norm(dim=1).max())
+                    for start in range(0, N, block_size)), default=0.0) or 1.0
+
+    def _transform(self, X, block_size: int = None):
+        D = X.shape[1]
+        max_norm = self.max_norm if self.max_norm is not None else self._max_norm(X, block_size)
+
+        def lift(block):
+            block = block / max_norm
+            lift_col = torch.sqrt(torch.clamp(1 - (block ** 2).sum(dim=1, keepdim=True), min=0))
+            return torch.cat((block, lift_col), dim=1)
+
+        return D + 1, lift
+
+
+class EuclideanDistance(LSHDistanceMetric):
+    """
+    p-stable LSH for the Euclidean distance of normalized embeddings, with the similarity of EuclideanDistanceDecoder:
+    sim(u, v) = 1 - ||u / ||u|| - v / ||v||||, i.e. in [-1, 1].
+    Every row of a band hashes a node to the bucket floor((a.x + b) / w) of a Gaussian projection a with an offset b
+    drawn uniformly from [0, w). Bucket indices are used as key words directly, so a key has one word per row.
+    """
+
+    def __init__(self, bands: int, rows: int, w: float = 0.25, seed: int = None, hyperplanes: HyperplaneBank = None):
+        """
+        :param w: Bucket width of the quantized projections. Larger widths put more distant nodes into one bucket
+        :param seed: Seed for drawing the projections
+        :param hyperplanes: Existing hyperplane bank to share, takes precedence over seed
+        """
+        super(EuclideanDistance, self).__init__()
+        self.bands = bands
+        self.rows = rows
+        self.w = w
+        self.hyperplanes = hyperplanes if hyperplanes is not None else HyperplaneBank(seed)
+
+    def sim(self, v1, v2):
+        return 1 - torch.norm(v1 / torch.norm(v1) - v2 / torch.norm(v2))
+
+    def pairwise_sim(self, embeddings):
+        embeddings = F.normalize(embeddings, dim=1)
+        return 1 - torch.cdist(embeddings, embeddings)
+
+    def paired_sim(self, v1, v2):
+        """
+        :return: similarity of every row in v1 with the same row in v2, shape (k,)
+        """
+        return 1 - torch.norm(F.normalize(v1, dim=1) - F.normalize(v2, dim=1), dim=1)
+
+    def dist(self, v1, v2):
+        return 1 - self.sim(v1, v2)
+
+    def pairwise_collision_probability(self, embeddings):
+        """
+        Collision probability of Datar et al. for a Gaussian projection and bucket width w at distance c of the
+        normalized vectors: 1 - 2 Phi(-w / c) - 2 / (sqrt(2 pi) w / c) (1 - exp(-(w / c)^2 / 2))
+        """
+        embeddings = F.normalize(embeddings, dim=1)
+        ratio = self.w / torch.clamp(torch.cdist(embeddings, embeddings), min=1e-12)
+
+        return (1 - 2 * torch.special.ndtr(-ratio)
+                - 2 / (math.sqrt(2 * math.pi) * ratio) * (1 - torch.exp(-ratio ** 2 / 2)))
+
+    def key_words(self):
+        return self.rows
+
+    def with_shape(self, bands: int, rows: int):
+        return EuclideanDistance(bands, rows, w=self.w, hyperplanes=self.hyperplanes)
+
+    def _projections(self, D: int, device):
+        """
+        :return: projections of shape (bands, rows, D) and offsets in [0, w) of shape (bands, rows)
+        """
+        planes = self.hyperplanes.get(D + 1, self.bands, self.rows, device)
+
+        # The extra coordinate of every drawn vector becomes a uniform offset through the normal CDF
+        return planes[..., :D], torch.special.ndtr(planes[..., D]) * self.w
+
+    def _positions(self, block, planes, offsets):
+        """
+        :return: projections of the normalized block in units of w, shape (bands, rows, n_samples)
+        """
+        block = F.normalize(block, dim=1)
+        return (torch.einsum('brd,nd->brn', planes, block) + offsets[..., None]) / self.w
+
     def signature(self, X: torch.Tensor):
         """
-        :return: signature matrix with shape (n_samples, bands, rows)
+        :return: bucket indices with shape (bands, rows, n_samples)
         """
-        device = X.device
+        return self.packed_signature(X)
+
+    def packed_signature(self, X, block_size: int = None, out: torch.Tensor = None):
+        """
+        Computes the bucket indices of all rows, streaming over blocks of nodes.
+        :param X: Embeddings of shape (n_samples, D), either a tensor or a memory-mapped array from load_embeddings
+        :param block_size: Number of nodes to hash at once, all nodes if None
+        :param out: Optional int64 tensor of shape (bands, rows, n_samples) that the keys are written to
+        :return: int64 tensor with shape (bands, rows, n_samples)
+        """
+        device = X.device if isinstance(X, torch.Tensor) else torch.device('cpu')
         N, D = X.shape
 
-        augment_col = X.norm(dim=1)
-        augmented = X / augment_col.max()
-        augment_col = torch.sqrt(1 - augmented.norm(dim=1))[:, None]
+        planes, offsets = self._projections(D, device)
 
-        augmented = np.cat((augmented, augment_col), dim=1)
+        if out is None:
+            out = torch.zeros((self.bands, self.rows, N), dtype=torch.long, device=device)
+        assert list(out.shape) == [self.bands, self.rows, N], "out has the wrong shape"
 
-        distribution = MultivariateNormal(torch.zeros(D), torch.eye(D))
-        random_planes = distribution.sample((self.bands * self.rows,)).to(device)
+        block_size = block_size or max(N, 1)
 
-        signature_matrix = (torch.mm(random_planes, augmented.t()) >= 0).int() * 2 - 1
-        return signature_matrix.reshape(self.bands, self.rows, N)
+        for start in range(0, N, block_size):
+            block = as_tensor(X[start:start + block_size]).to(device=device, dtype=planes.dtype)
+            out[:, :, start:start + block.size(0)] = torch.floor(self._positions(block, planes, offsets)).long()
+
+        return out
+
+    def probe_keys(self, X, band_keys: torch.Tensor, band: int, n_probes: int, block_size: int = None):
+        """
+        Keys of the neighboring buckets of one band for multi-probe LSH. The j-th probe of a node moves it one bucket
+        along the projection on which it lies j-th closest to a bucket boundary, towards that boundary.
+        :param X: Embeddings of shape (n_samples, D) that band_keys were computed from
+        :param band_keys: keys of the band with shape (rows, n_samples)
+        :param block_size: Number of nodes to project at once, all nodes if None
+        :return: int64 tensor with shape (n_probes, rows, n_samples)
+        """
+        device = band_keys.device
+        N, D = X.shape
+        n_probes = min(n_probes, self.rows)
+
+        planes, offsets = self._projections(D, device)
+        planes, offsets = planes[band:band + 1], offsets[band:band + 1]
+        probes = band_keys.unsqueeze(0).repeat(n_probes, 1, 1)
+
+        block_size = block_size or max(N, 1)
+
+        for start in range(0, N, block_size):
+            block = as_tensor(X[start:start + block_size]).to(device=device, dtype=planes.dtype)
+            stop = start + block.size(0)
+
+            positions = self._positions(block, planes, offsets)[0]
+            fractions = positions - torch.floor(positions)
+            probe_rows = torch.topk(torch.minimum(fractions, 1 - fractions), n_probes, dim=0, largest=False)[1]
+            steps = torch.where(fractions.gather(0, probe_rows) < 0.5, -1, 1)
+
+            probes[:, :, start:stop].scatter_add_(1, probe_rows.unsqueeze(1), steps.unsqueeze(1))
+
+        return probes
+
+
+# Metrics by the name of the matching decoder in modules.create_decoder
+LSH_METRICS = {'cosine': CosineSimilarity, 'dot': DotProductSimilarity, 'l2': EuclideanDistance}
+
+
+class PairAccumulator(object):
+    """
+    Collects (row, col, similarity) triples in preallocated buffers that grow geometrically, so appending k pairs
+    costs amortized O(k) instead of copying everything found so far like repeated torch.cat calls do.
+    """
+
+    def __init__(self, capacity: int = 1024, device=None):
+        self.size = 0
+        self.indices = torch.empty((2, capacity), dtype=torch.long, device=device)
+        self.values = torch.empty(capacity, dtype=torch.float, device=device)
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, capacity):
+        if capacity <= self.indices.size(1):
+            return
+
+        # Double the buffers until the new pairs fit, keeping only the filled part
+        new_capacity = max(capacity, 2 * self.indices.size(1))
+
+        indices = torch.empty((2, new_capacity), dtype=self.indices.dtype, device=self.indices.device)
+        indices[:, :self.size] = self.indices[:, :self.size]
+        values = torch.empty(new_capacity, dtype=self.values.dtype, device=self.values.device)
+        values[:self.size] = self.values[:self.size]
+
+        self.indices, self.values = indices, values
+
+    def append(self, rows, cols, values):
+        """
+        :param rows: LongTensor of shape (k,) with the first node of each pair
+        :param cols: LongTensor of shape (k,) with the second node of each pair
+        :param values: tensor of shape (k,) with the similarity of each pair
+        """
+        k = values.size(0)
+        self._reserve(self.size + k)
+
+        self.indices[0, self.size:self.size + k] = rows
+        self.indices[1, self.size:self.size + k] = cols
+        self.values[self.size:self.size + k] = values
+        self.size += k
+
+    @classmethod
+    def merge(cls, accumulators, n_nodes: int):
+        """
+        Combines several accumulators of pairs (row, col) with row < col, keeping the first copy of every pair that
+        was collected more than once.
+        """
+        indices = torch.cat([pairs.indices[:, :pairs.size] for pairs in accumulators], dim=1)
+        values = torch.cat([pairs.values[:pairs.size] for pairs in accumulators], dim=0)
+
+        keys = indices[0] * n_nodes + indices[1]
+        unique_keys, inverse = torch.unique(keys, return_inverse=True)
+        positions = torch.arange(keys.size(0), device=keys.device)
+        first = torch.full_like(unique_keys, keys.size(0)).scatter_reduce_(0, inverse, positions, reduce='amin')
+
+        merged = cls(capacity=first.size(0), device=indices.device)
+        merged.append(indices[0, first], indices[1, first], values[first])
+        return merged
+
+    def _flushed(self, symmetric: bool):
+        # Pairs are collected for evaluation only, so the values never carry a graph into the flushed matrices
+        indices, values = self.indices[:, :self.size], self.values[:self.size].detach()
+
+        if symmetric:
+            indices = torch.cat((indices, indices.flip(0)), dim=1)
+            values = torch.cat((values, values), dim=0)
+
+        return indices, values
+
+    def to_sparse(self, n_nodes: int, symmetric: bool = False):
+        """
+        Flushes all collected pairs into a single sparse COO matrix.
+        :param symmetric: Whether to also add the mirrored pair (col, row) for every collected pair
+        :return: uncoalesced torch.sparse.FloatTensor with shape (n_nodes, n_nodes)
+        """
+        indices, values = self._flushed(symmetric)
+
+        return torch.sparse.FloatTensor(
+            indices=indices,
+            values=values,
+            size=torch.Size([n_nodes, n_nodes])
+        )
+
+    def _csr_parts(self, n_nodes: int, symmetric: bool):
+        """
+        :return: (crow_indices, col_indices, values) of the collected pairs in CSR order. Indices are int32 if both
+         n_nodes and the number of stored pairs are small enough, since crow_indices counts up to the latter
+        """
+        indices, values = self._flushed(symmetric)
+        index_dtype = torch.int32 if max(n_nodes, values.size(0)) < 2 ** 31 else torch.long
+
+        order = torch.argsort(indices[0] * n_nodes + indices[1])
+        rows, cols, values = indices[0, order], indices[1, order], values[order]
+
+        crow_indices = torch.zeros(n_nodes + 1, dtype=torch.long, device=indices.device)
+        crow_indices[1:] = torch.cumsum(torch.bincount(rows, minlength=n_nodes), dim=0)
+
+        return crow_indices.to(index_dtype), cols.to(index_dtype), values
+
+    def to_csr(self, n_nodes: int, symmetric: bool = False, dtype: torch.dtype = None):
+        """
+        Flushes all collected pairs into a CSR matrix. Unlike to_sparse, pairs have to be distinct to get a
+        coalesced result, since duplicates are kept instead of summed.
+        :param symmetric: Whether to also add the mirrored pair (col, row) for every collected pair
+        :param dtype: dtype of the values, e.g. torch.float16 or torch.bool. Float32 if None
+        :return: torch.sparse_csr_tensor with shape (n_nodes, n_nodes) and int32 indices if n_nodes and nnz < 2^31
+        """
+        crow_indices, col_indices, values = self._csr_parts(n_nodes, symmetric)
+
+        return torch.sparse_csr_tensor(crow_indices, col_indices, values.to(dtype or values.dtype),
+                                       size=(n_nodes, n_nodes))
+
+    def to_scipy(self, n_nodes: int, symmetric: bool = False, dtype: torch.dtype = None):
+        """
+        Flushes all collected pairs into a scipy CSR matrix on the CPU, see to_csr.
+        :return: scipy.sparse.csr_matrix with shape (n_nodes, n_nodes)
+        """
+        crow_indices, col_indices, values = (part.cpu() for part in self._csr_parts(n_nodes, symmetric))
+
+        return sp.csr_matrix((values.to(dtype or values.dtype).numpy(), col_indices.numpy(), crow_indices.numpy()),
+                             shape=(n_nodes, n_nodes))
+
+
+def merge_topk(indices: torch.Tensor, similarities: torch.Tensor, rows, cols, pair_similarities):
+    """
+    Merges verified pairs into the running top-k neighbors of both of their nodes, in place.
+    :param indices: LongTensor of shape (N, k) with the current neighbors of every node, -1 for empty entries
+    :param similarities: tensor of shape (N, k) with the similarities to them sorted decreasingly, -inf if empty
+    :param rows: first nodes of the pairs
+    :param cols: second nodes of the pairs
+    :param pair_similarities: similarities of the pairs
+    """
+    k = indices.size(1)
+
+    # Every pair is a candidate for both of its nodes
+    nodes = torch.cat((rows, cols))
+    neighbors = torch.cat((cols, rows))
+    candidate_similarities = torch.cat((pair_similarities, pair_similarities)).to(similarities.dtype)
+
+    # Only the rows of touched nodes are merged, each of them starts with its k current entries
+    touched = torch.unique(nodes)
+    nodes = torch.cat((touched.repeat_interleave(k), nodes))
+    neighbors = torch.cat((indices[touched].flatten(), neighbors))
+    candidate_similarities = torch.cat((similarities[touched].flatten(), candidate_similarities))
+
+    # Group by node and sort each group by decreasing similarity
+    order = torch.argsort(candidate_similarities, descending=True, stable=True)
+    order = order[torch.sort(nodes[order], stable=True)[1]]
+
+    # Keep the first k entries of every group, groups have at least k entries and follow the order of touched
+    counts = torch.unique_consecutive(nodes[order], return_counts=True)[1]
+    rank = torch.arange(order.size(0), device=order.device) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts,
+                                                                                     counts)
+    keep = order[rank < k]
+
+    indices[touched] = neighbors[keep].view(-1, k)
+    similarities[touched] = candidate_similarities[keep].view(-1, k)
+
+
+class PairKeySet(object):
+    """
+    Compact set of node pairs (i, j), each encoded as the int64 key i * n_nodes + j.
+    Keys are kept in a few sorted runs of geometrically decreasing size, so inserting the keys of a band only sorts
+    the new keys and occasionally merges runs, instead of re-sorting the whole set every time.
+    """
+
+    def __init__(self, n_nodes: int, device=None):
+        self.n_nodes = n_nodes
+        self.device = device
+        self.runs = []
+
+    def __len__(self):
+        return sum(run.size(0) for run in self.runs)
+
+    def encode(self, rows, cols):
+        return rows * self.n_nodes + cols
+
+    def contains(self, keys):
+        """
+        :return: BoolTensor of the same shape as keys, True for keys that are in the set
+        """
+        found = torch.zeros_like(keys, dtype=torch.bool)
+
+        for run in self.runs:
+            positions = torch.searchsorted(run, keys).clamp(max=run.size(0) - 1)
+            found |= run[positions] == keys
+
+        return found
+
+    def update(self, keys):
+        """
+        Adds keys to the set. Keys must not be contained in the set yet, which contains() can ensure.
+        """
+        keys = torch.unique(keys)
+        if keys.size(0) == 0:
+            return
+
+        self.runs.append(keys)
+
+        # Merge runs of similar size, keeping O(log n) runs with O(n log n) total merging work
+        while len(self.runs) >= 2 and self.runs[-2].size(0) <= 2 * self.runs[-1].size(0):
+            last = self.runs.pop()
+            self.runs[-1] = torch.sort(torch.cat((self.runs[-1], last)))[0]
 
 
 class LSHDecoder(torch.nn.Module):
@@ -105,83 +822,362 @@ class LSHDecoder(torch.nn.Module):
                  rows: int = 8,
                  metric: LSHDistanceMetric = CosineSimilarity,
                  verbose: bool = False,
-                 assure_correctness=True):
+                 assure_correctness=True,
+                 batch_memory: int = 2 ** 28,
+                 max_bucket_size: int = None,
+                 oversized_buckets: str = 'tile',
+                 split_rows: int = 8,
+                 max_split_depth: int = 4,
+                 block_size: int = None,
+                 seed: int = None,
+                 k: int = None,
+                 n_probes: int = 0,
+                 n_jobs: int = 1,
+                 output: str = 'coo',
+                 value_dtype: torch.dtype = None):
+        """
+        :param batch_memory: Memory budget in bytes for verifying one batch of candidate pairs
+        :param max_bucket_size: Buckets with more nodes are treated as oversized. Defaults to the largest bucket whose
+         pairs still fit into one verification batch
+        :param oversized_buckets: How to handle oversized buckets, one of ['tile', 'split']. 'tile' verifies all their
+         pairs exactly in batches, 'split' re-hashes them with split_rows additional hyperplanes (losing the pairs that
+         end up in different sub-buckets) and tiles the ones that are still oversized after max_split_depth splits
+        :param block_size: Number of nodes hashed at once when computing the signature, all nodes if None
+        :param seed: Seed for the hyperplanes of the metric. They are stored in the state dict of the decoder
+        :param k: If given, forward returns the k nearest neighbors of every node as (indices, similarities) tensors of
+         shape (N, k) instead of the thresholded sparse matrix, see recover_neighbors
+        :param n_probes: Number of neighboring buckets to probe per node and band (multi-probe LSH). Probing needs the
+         signature to come from this decoder's metric
+        :param n_jobs: Number of threads that hash and verify disjoint sets of bands in parallel
+        :param output: Format of the sparse matrix, one of ['coo', 'csr', 'scipy']. 'coo' is an uncoalesced
+         torch.sparse.FloatTensor, 'csr' a coalesced torch CSR tensor and 'scipy' a scipy.sparse.csr_matrix. Both CSR
+         formats use int32 indices for less than 2^31 nodes
+        :param value_dtype: dtype of the values of the CSR formats, e.g. torch.float16, or torch.bool for just the
+         edges. Float32 if None
+        """
+        assert oversized_buckets in ['tile', 'split'], "oversized_buckets must be 'tile' or 'split'"
+        assert output in ['coo', 'csr', 'scipy'], "output must be 'coo', 'csr' or 'scipy'"
 
         super(LSHDecoder, self).__init__()
         self.sim_thresh = sim_thresh
         self.bands = bands
         self.rows = rows
         self.verbose = verbose
-        self.sim_metric_str = 'cosine' if metric is CosineSimilarity else 'dot'
-        self.sim_metric = metric(bands, rows)
+        self.sim_metric_str = {cls: name for name, cls in LSH_METRICS.items()}.get(metric)
+        self.sim_metric = metric(bands, rows, seed=seed)
         self.assure_correctness = assure_correctness
+        self.batch_memory = batch_memory
+        self.max_bucket_size = max_bucket_size
+        self.oversized_buckets = oversized_buckets
+        self.split_rows = split_rows
+        self.max_split_depth = max_split_depth
+        self.block_size = block_size
+        self.k = k
+        self.n_probes = n_probes
+        self.n_jobs = n_jobs
+        self.output = output
+        self.value_dtype = value_dtype
 
-    def recover_duplicates(self, signature_matrix, embeddings):
+        # Number of buckets that took each verification path and of distinct pairs verified in the last call of
+        # recover_duplicates or recover_neighbors
+        self.bucket_stats = Counter()
+        self.n_verified = 0
 
-        N, D = embeddings.shape
-        assert list(signature_matrix.shape) == [self.bands, self.rows, N]
+    def _batch_size(self, embeddings):
+        """
+        :return: number of candidate pairs that can be verified at once within the memory budget
+        """
+        # Both gathered embeddings plus row, col, key and similarity of every pair
+        bytes_per_pair = 2 * embeddings.shape[1] * as_tensor(embeddings[:1]).element_size() + 3 * 8 + 4
+        return max(1, self.batch_memory // bytes_per_pair)
+
+    def _candidate_batches(self, nodes, offsets, sizes, batch_size):
+        """
+        Splits the buckets of a band into consecutive groups of at most batch_size candidate pairs, except for single
+        buckets that are bigger than that on their own.
+        :return: generator of (rows, cols) LongTensors with all candidate pairs of a group of buckets
+        """
+        n_buckets = sizes.size(0)
+        cumulative_pairs = torch.cumsum(sizes * (sizes - 1) // 2, dim=0)
+
+        start, done = 0, 0
+        while start < n_buckets:
+            stop = int(torch.searchsorted(cumulative_pairs, done + batch_size, right=True))
+            stop = max(stop, start + 1)
+
+            yield bucket_pairs(nodes, offsets[start:stop], sizes[start:stop])
+
+            done = int(cumulative_pairs[stop - 1])
+            start = stop
+
+    def _band_candidates(self, nodes, offsets, sizes, embeddings, batch_size, stats, depth=0):
+        """
+        Generates the candidate pairs of all buckets of a band, handling oversized buckets separately.
+        :return: generator of (rows, cols) LongTensors with rows < cols
+        """
+        if self.max_bucket_size is not None:
+            max_bucket_size = self.max_bucket_size
+        else:
+            # Largest k with k * (k - 1) / 2 <= batch_size
+            max_bucket_size = max(2, int((1 + math.sqrt(1 + 8 * batch_size)) / 2))
+
+        # Only buckets with at least two nodes can produce pairs
+        oversized = sizes > max_bucket_size
+        regular = (sizes >= 2) & ~oversized
+
+        stats['regular'] += int(regular.sum())
+        yield from self._candidate_batches(nodes, offsets[regular], sizes[regular], batch_size)
+
+        for offset, size in zip(offsets[oversized].tolist(), sizes[oversized].tolist()):
+            members = nodes[offset:offset + size]
 
-        # Don't need to use .cpu().numpy() if we just want to access the data
-        # https://discuss.pytorch.org/t/get-value-out-of-torch-cuda-float-tensor/2539/4
-        signature = signature_matrix.detach()
+            if self.oversized_buckets == 'split' and depth < self.max_split_depth:
+                stats['split'] += 1
+
+                # Additional hyperplanes from the metric's bank. Hashing depth + 1 bands and using the last one gives
+                # every split level its own hyperplanes. Sub-buckets keep their members in ascending order
+                split_metric = self.sim_metric.with_shape(depth + 1, self.split_rows)
+                sub_keys = split_metric.packed_signature(gather_rows(embeddings, members))[depth]
+                sub_nodes, sub_offsets, sub_sizes = bucket_band(sub_keys)
+
+                yield from self._band_candidates(members[sub_nodes], sub_offsets, sub_sizes, embeddings, batch_size,
+                                                 stats, depth + 1)
+            else:
+                stats['tiled'] += 1
+                yield from tile_pairs(members, batch_size)
+
+    def _probe_candidates(self, band_keys, probe_keys, batch_size, stats):
+        """
+        Pairs every node with the nodes of the neighboring buckets its probe keys point to.
+        :param band_keys: packed keys of the band with shape (words, N)
+        :param probe_keys: packed probe keys of the band with shape (n_probes, words, N), see probe_keys of the metric
+        :return: generator of (rows, cols) LongTensors with rows < cols and no pair repeated
+        """
+        words, N = band_keys.shape
+        n_probes = probe_keys.size(0)
+        device = band_keys.device
 
-        bands_loop = tqdm(range(self.bands), desc="Hashing values in signature matrix") if self.verbose else range(
-            self.bands)
+        if N == 0:
+            return
 
-        pairs_indices = torch.LongTensor().to(signature_matrix.device)
-        pairs_similarites = torch.FloatTensor().to(signature_matrix.device)
+        # Give home and probe keys common bucket ids, probe j of node i ends up at N + j * N + i
+        all_keys = torch.cat((band_keys, probe_keys.permute(1, 0, 2).reshape(words, n_probes * N)), dim=1)
+        if words == 1:
+            bucket_ids = torch.unique(all_keys[0], return_inverse=True)[1]
+        else:
+            bucket_ids = torch.unique(all_keys.t(), dim=0, return_inverse=True)[1]
+
+        home_ids, probe_ids = bucket_ids[:N], bucket_ids[N:]
+        nodes = torch.sort(home_ids, stable=True)[1]
+        sizes = torch.bincount(home_ids, minlength=int(bucket_ids.max()) + 1)
+        offsets = torch.cumsum(sizes, 0) - sizes
+
+        # Only probes that hit an occupied bucket produce pairs
+        probing_nodes = torch.arange(N, device=device).repeat(n_probes)
+        n_targets = sizes[probe_ids]
+        hit = n_targets > 0
+        probing_nodes, probe_ids, n_targets = probing_nodes[hit], probe_ids[hit], n_targets[hit]
+        stats['probed'] += probing_nodes.size(0)
+
+        cumulative_targets = torch.cumsum(n_targets, dim=0)
+
+        start, done = 0, 0
+        while start < probing_nodes.size(0):
+            stop = int(torch.searchsorted(cumulative_targets, done + batch_size, right=True))
+            stop = max(stop, start + 1)
+
+            targets = n_targets[start:stop]
+            rows = torch.repeat_interleave(probing_nodes[start:stop], targets)
+            target_rank = torch.arange(rows.size(0), device=device) - torch.repeat_interleave(
+                torch.cumsum(targets, 0) - targets, targets)
+            cols = nodes[torch.repeat_interleave(offsets[probe_ids[start:stop]], targets) + target_rank]
+
+            # Two nodes can probe each other's bucket, keep every unordered pair once
+            keys = torch.unique(torch.min(rows, cols) * N + torch.max(rows, cols))
+            yield keys // N, keys % N
+
+            done = int(cumulative_targets[stop - 1])
+            start = stop
+
+    def _packed(self, signature_matrix, N):
+        if signature_matrix.dtype == torch.long:
+            assert list(signature_matrix.shape) == [self.bands, self.sim_metric.key_words(), N]
+            signature = signature_matrix.detach()
+        else:
+            assert list(signature_matrix.shape) == [self.bands, self.rows, N]
+            signature = pack_signature(signature_matrix.detach())
 
         print(f"Size of Signature: {signature.element_size() * signature.nelement() / 10 ** 6}")
+        return signature
 
-        for band in bands_loop:
-            hashtable = defaultdict(list)
+    def _verified_pairs(self, signature, embeddings, bands, stats, done=None, band_nodes=None):
+        """
+        Hashes the nodes of the given bands into buckets and verifies each candidate pair once, in batches.
+        :param signature: bit-packed signature with shape (bands, words, N)
+        :param bands: indices of the bands to hash
+        :param stats: Counter that the number of buckets per verification path and of candidate, skipped and verified
+         pairs are added to
+        :param done: Optional BoolTensor of shape (N,) that may be updated in place between batches. Pairs of two done
+         nodes are skipped and no further bands are hashed once all nodes are done
+        :param band_nodes: Optional LongTensor for every entry of bands with the ascending subset of the nodes to hash
+         in that band, all nodes if not given. The subsets must contain complete buckets
+        :return: generator of (rows, cols, similarities) with rows < cols
+        """
+        N = embeddings.shape[0]
 
-            elems_loop = tqdm(range(N), desc=f"Hashing nodes to buckets") if self.verbose else range(N)
+        bands_loop = tqdm(bands, desc="Hashing values in signature matrix") if self.verbose else bands
 
-            for i in elems_loop:
-                # Only bring one band column to the CPU at a time to reduce memory overhead
-                key = hash(signature[band, :, i].cpu().numpy().data.tobytes())
-                hashtable[key].append(i)
+        # Candidate pairs that were already checked
+        seen = PairKeySet(N, device=signature.device)
 
-            dupes_loop = tqdm(hashtable.items(),
-                              desc=f"Checking elements in same bucket") if self.verbose else hashtable.items()
+        batch_size = self._batch_size(embeddings)
 
-            for _, duplicates in dupes_loop:
-                if len(duplicates) < 2:
-                    continue
+        for i, band in enumerate(bands_loop):
+            if done is not None and bool(done.all()):
+                break
 
-                duplicates_embeddings = embeddings[duplicates]
-                duplicates = torch.Tensor(duplicates)
+            if band_nodes is None:
+                nodes, offsets, sizes = bucket_band(signature[band])
+            else:
+                nodes, offsets, sizes = bucket_band(signature[band][:, band_nodes[i]])
+                nodes = band_nodes[i][nodes]
 
-                pairwise_sim = self.sim_metric.pairwise_sim(duplicates_embeddings)
+            candidates = self._band_candidates(nodes, offsets, sizes, embeddings, batch_size, stats)
 
-                # Remove self loops manually
-                diagonal_indices = np.diag_indices(duplicates.size(0))
-                pairwise_sim[diagonal_indices[0], diagonal_indices[1]] = -np.inf
+            if self.n_probes > 0:
+                probe_keys = self.sim_metric.probe_keys(embeddings, signature[band], band, self.n_probes,
+                                                        block_size=self.block_size)
+                candidates = itertools.chain(candidates,
+                                             self._probe_candidates(signature[band], probe_keys, batch_size, stats))
 
-                # Calculate connections with high enough similarity
-                pairs = pairwise_sim >= (self.sim_thresh if self.assure_correctness else -np.inf)
+            for rows, cols in candidates:
+                stats['candidates'] += rows.size(0)
 
-                # Nonzero values are now wanted connections, add to existing ones
-                nonzero_indices = pairs.nonzero()
+                if done is not None:
+                    active = ~(done[rows] & done[cols])
+                    stats['skipped'] += rows.size(0) - int(active.sum())
+                    rows, cols = rows[active], cols[active]
 
-                # Add distances to array. TODO: Potentially just add 1 and use LongTensor instead of FloatTensor
-                pairs_similarites = torch.cat((pairs_similarites,
-                                               pairwise_sim[nonzero_indices[:, 0], nonzero_indices[:, 1]]), dim=0)
+                # Batches never repeat a pair, so checking against earlier batches suffices
+                keys = seen.encode(rows, cols)
+                unseen = ~seen.contains(keys)
+                rows, cols = rows[unseen], cols[unseen]
+                seen.update(keys[unseen])
+                stats['verified'] += rows.size(0)
 
-                # Convert local indices (only ones in bucket) to global node indices
-                nonzero_indices[:, 0] = duplicates[nonzero_indices[:, 0]]
-                nonzero_indices[:, 1] = duplicates[nonzero_indices[:, 1]]
-                pairs_indices = torch.cat((pairs_indices, nonzero_indices), dim=0)
+                # Verify all new candidates of the batch at once
+                similarities = self.sim_metric.paired_sim(gather_rows(embeddings, rows), gather_rows(embeddings, cols))
 
-        return torch.sparse.FloatTensor(
-            indices=pairs_indices.t(),
-            values=pairs_similarites,
-            size=torch.Size([N, N])
-        )
+                yield rows, cols, similarities
+
+    def _record_stats(self, stats):
+        n_candidates, n_skipped = stats.pop('candidates', 0), stats.pop('skipped', 0)
+        self.n_verified = stats.pop('verified', 0)
+        self.bucket_stats = stats
+
+        if self.verbose:
+            print(f"Checked {self.n_verified} distinct candidate pairs, skipped "
+                  f"{n_candidates - n_skipped - self.n_verified} duplicates and {n_skipped} pairs of done nodes.")
+            print(f"Buckets per verification path: {dict(self.bucket_stats)}")
+
+    def _collect_pairs(self, signature, embeddings, bands, band_nodes=None):
+        """
+        Collects the verified pairs of the given bands that pass the similarity threshold.
+        :return: (PairAccumulator, Counter with the statistics of _verified_pairs)
+        """
+        pairs, stats = PairAccumulator(device=signature.device), Counter()
+
+        for rows, cols, similarities in self._verified_pairs(signature, embeddings, bands, stats,
+                                                             band_nodes=band_nodes):
+            # Only keep connections with high enough similarity
+            if self.assure_correctness:
+                connections = similarities >= self.sim_thresh
+                rows, cols, similarities = rows[connections], cols[connections], similarities[connections]
+
+            pairs.append(rows, cols, similarities)
+
+        return pairs, stats
+
+    def recover_duplicates(self, signature_matrix, embeddings):
+        """
+        :param signature_matrix: bit-packed signature with shape (bands, words, N) as returned by packed_signature,
+         or an unpacked +-1 signature with shape (bands, rows, N)
+        :param embeddings: tensor or memory-mapped array of shape (N, D)
+        :return: sparse (N, N) matrix with the similarities of all detected pairs, in the format given by output
+        """
+        N, D = embeddings.shape
+        signature = self._packed(signature_matrix, N)
+
+        # Round robin assignment of the bands to the workers
+        n_jobs = max(1, min(self.n_jobs, self.bands))
+        band_groups = [list(range(self.bands))[job::n_jobs] for job in range(n_jobs)]
+
+        if n_jobs == 1:
+            pairs, stats = self._collect_pairs(signature, embeddings, band_groups[0])
+        else:
+            # Torch releases the GIL in its kernels, and the threads share the signature and embeddings without copies
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(lambda bands: self._collect_pairs(signature, embeddings, bands),
+                                            band_groups))
+
+            # Different workers may have found the same pair
+            pairs = PairAccumulator.merge([result[0] for result in results], N)
+            stats = sum((result[1] for result in results), Counter())
+
+        self._record_stats(stats)
+
+        return self._to_output(pairs, N)
+
+    def _to_output(self, pairs: PairAccumulator, N: int):
+        """
+        :return: symmetric sparse (N, N) matrix of the pairs in the configured output format
+        """
+        if self.output == 'csr':
+            return pairs.to_csr(N, symmetric=True, dtype=self.value_dtype)
+        elif self.output == 'scipy':
+            return pairs.to_scipy(N, symmetric=True, dtype=self.value_dtype)
+
+        return pairs.to_sparse(N, symmetric=True)
+
+    def recover_neighbors(self, signature_matrix, embeddings, k: int):
+        """
+        Ranks the candidates from the union of all buckets of a node to find its k most similar nodes.
+        Nodes stop looking for candidates once they have k neighbors with a similarity of at least sim_thresh.
+        Bands are always processed sequentially here, since the early stopping depends on all bands seen so far.
+        :param signature_matrix: signature as for recover_duplicates
+        :param embeddings: tensor or memory-mapped array of shape (N, D)
+        :return: (indices, similarities) tensors of shape (N, k), sorted by decreasing similarity. Nodes with less
+         than k candidates are padded with index -1 and similarity -inf
+        """
+        N, D = embeddings.shape
+        signature = self._packed(signature_matrix, N)
+
+        indices = torch.full((N, k), -1, dtype=torch.long, device=signature.device)
+        similarities = torch.full((N, k), -np.inf, device=signature.device)
+        done = torch.zeros(N, dtype=torch.bool, device=signature.device)
+        stats = Counter()
+
+        for rows, cols, pair_similarities in self._verified_pairs(signature, embeddings, range(self.bands), stats,
+                                                                  done=done):
+            merge_topk(indices, similarities, rows, cols, pair_similarities)
+            done[:] = similarities[:, -1] >= self.sim_thresh
+
+        self._record_stats(stats)
+
+        return indices, similarities
+
+    def get_extra_state(self):
+        return {'hyperplanes': self.sim_metric.hyperplanes.state_dict()}
+
+    def set_extra_state(self, state):
+        self.sim_metric.hyperplanes.load_state_dict(state['hyperplanes'])
 
     def forward(self, Z):
-        signature_matrix = self.sim_metric.signature(Z)
+        signature_matrix = self.sim_metric.packed_signature(Z, block_size=self.block_size)
+
+        if self.k is not None:
+            return self.recover_neighbors(signature_matrix, Z, self.k)
+
         pairs_matrix = self.recover_duplicates(signature_matrix, Z)
 
         return pairs_matrix
@@ -12,7 +12,8 @@ sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
 from graph.utils import *
 from graph.early_stopping import EarlyStopping
 from graph.modules import *
-from graph.torch_lsh import LSHDecoder
+from graph.torch_lsh import LSH_METRICS, LSHDecoder
+from graph.tuning import tune_lsh
 
 
 def run_experiment(args):
@@ -108,6 +109,48 @@ def run_experiment(args):
 
         return precision, recall
 
+    def test_exact_graph(z, sample_size=1000):
+        """
+        Exact thresholded graph built block by block, for graphs whose dense adjacency matrix does not fit in memory
+        """
+        sigmoid = args.decoder == 'dot'
+
+        if args.min_sim_absolute_value is None:
+            args.min_sim_absolute_value, _ = sample_percentile(args.min_sim, z, dist_measure=args.decoder,
+                                                               sigmoid=sigmoid, sample_size=sample_size)
+
+        t = time.time()
+        adjacency = model.decoder.forward_thresholded(z, args.min_sim_absolute_value,
+                                                      block_size=args.exact_block_size, sigmoid=sigmoid)
+
+        print(f"Computing exact graph took {time.time() - t} seconds.")
+        print(f"Adjacency matrix takes {sparse_size(adjacency)} MB of memory.")
+
+        precision, recall = sparse_precision_recall(data, adjacency)
+
+        print("Predicted exact adjacency matrix has precision {} and recall {}!".format(precision, recall))
+
+        return precision, recall
+
+    def test_streamed_graph(z, sample_size=1000):
+        """
+        Precision and recall of the exact thresholded graph counted block by block, without building the graph
+        """
+        sigmoid = args.decoder == 'dot'
+
+        if args.min_sim_absolute_value is None:
+            args.min_sim_absolute_value, _ = sample_percentile(args.min_sim, z, dist_measure=args.decoder,
+                                                               sigmoid=sigmoid, sample_size=sample_size)
+
+        t = time.time()
+        precision, recall = streaming_precision_recall(data, model.decoder, z, args.min_sim_absolute_value,
+                                                       block_size=args.exact_block_size or 1024, sigmoid=sigmoid)
+
+        print(f"Streaming evaluation took {time.time() - t} seconds.")
+        print("Predicted exact adjacency matrix has precision {} and recall {}!".format(precision, recall))
+
+        return precision, recall
+
     def sample_graph(z, sample_size):
         N, D = z.shape
 
@@ -124,29 +167,59 @@ def run_experiment(args):
         :param assure_correctness:
         :return:
         """
+        if args.pr_curve_percentiles and args.pr_curve_thresholds is None:
+            pr_percentiles = np.sort(args.pr_curve_percentiles)
+            pr_thresholds, _ = sample_percentile(pr_percentiles, z, dist_measure=args.decoder)
+            if args.min_sim_absolute_value is None:
+                args.min_sim_absolute_value = pr_thresholds[0]
+
+            # The graphs of the lowest threshold contain the graphs of all higher thresholds, but none of lower ones
+            evaluated = pr_thresholds >= args.min_sim_absolute_value
+            if not evaluated.all():
+                print(f"Skipping percentiles {pr_percentiles[~evaluated].tolist()} below the minimum similarity.")
+            args.pr_curve_thresholds = (pr_percentiles[evaluated].tolist(), pr_thresholds[evaluated])
+        elif args.min_sim_absolute_value is None:
+            args.min_sim_absolute_value, _ = sample_percentile(args.min_sim, z, dist_measure=args.decoder)
+
         # Naive Adjacency-Matrix (Non-LSH-Version)
         t = time.time()
         # Don't use sigmoid in order to directly compare thresholds with LSH
-        naive_adjacency = model.decoder.forward_all(z, sigmoid=(args.decoder == 'dot'))
+        if args.exact_block_size is not None:
+            naive_adjacency = model.decoder.forward_thresholded(z, args.min_sim_absolute_value,
+                                                                block_size=args.exact_block_size, sigmoid=False)
+            naive_size = sparse_size(naive_adjacency)
+        else:
+            naive_adjacency = model.decoder.forward_all(z, sigmoid=False)
+            naive_size = naive_adjacency.element_size() * naive_adjacency.nelement() / 10 ** 6
         naive_time = time.time() - t
-        naive_size = naive_adjacency.element_size() * naive_adjacency.nelement() / 10 ** 6
 
-        if args.min_sim_absolute_value is None:
-            args.min_sim_absolute_value, _ = sample_percentile(args.min_sim, z, dist_measure=args.decoder)
+        if args.lsh_auto_tune:
+            tuned, _ = tune_lsh(z, args.min_sim_absolute_value, metric=LSH_METRICS[args.decoder],
+                                target_recall=args.lsh_target_recall)
+            args.lsh_bands, args.lsh_rows = tuned['bands'], tuned['rows']
 
         print("______________________________Naive Graph Computation KPI____________________________________________")
         print(f"Computing naive graph took {naive_time} seconds.")
         print(f"Naive adjacency matrix takes {naive_size} MB of memory.")
 
+        # Curves threshold the LSH values again, which needs them unrounded
+        lsh_values = torch.float32 if args.pr_curve_percentiles else getattr(torch, args.lsh_values)
+
         # LSH-Adjacency-Matrix:
         t = time.time()
         lsh_adjacency = LSHDecoder(bands=args.lsh_bands,
                                    rows=args.lsh_rows,
+                                   metric=LSH_METRICS[args.decoder],
+                                   block_size=args.lsh_block_size,
+                                   n_probes=args.lsh_probes,
+                                   n_jobs=args.lsh_jobs,
+                                   output=args.lsh_output,
+                                   value_dtype=lsh_values,
                                    verbose=True,
                                    assure_correctness=assure_correctness,
                                    sim_thresh=args.min_sim_absolute_value)(z)
         lsh_time = time.time() - t
-        lsh_size = lsh_adjacency.element_size() * lsh_adjacency._nnz() / 10 ** 6
+        lsh_size = sparse_size(lsh_adjacency)
 
         print("__________________________________LSH Graph Computation KPI__________________________________________")
         print(f"Computing LSH graph took {lsh_time} seconds.")
@@ -154,7 +227,10 @@ def run_experiment(args):
 
         print("________________________________________Precision-Recall_____________________________________________")
         # 1) Evaluation: Both Adjacency matrices against ground truth graph
-        naive_precision, naive_recall = dense_precision_recall(data, naive_adjacency, args.min_sim_absolute_value)
+        if naive_adjacency.is_sparse:
+            naive_precision, naive_recall = sparse_precision_recall(data, naive_adjacency)
+        else:
+            naive_precision, naive_recall = dense_precision_recall(data, naive_adjacency, args.min_sim_absolute_value)
 
         lsh_precision, lsh_recall = sparse_precision_recall(data, lsh_adjacency)
 
@@ -168,7 +244,26 @@ def run_experiment(args):
         print(
             f"LSH sparse matrix has {compare_precision} precision and {compare_recall} recall w.r.t. the naively generated dense matrix!")
 
-        return naive_precision, naive_recall, naive_time, naive_size, lsh_precision, lsh_recall, lsh_time, lsh_size, compare_precision, compare_recall
+        pr_curve = None
+        if args.pr_curve_percentiles:
+            pr_percentiles, pr_thresholds = args.pr_curve_thresholds
+            print("_______________________________________Precision-Recall Curves_______________________________________")
+            # 3) Evaluation: Both graphs for all thresholds in one pass over the similarities and the LSH pairs
+            naive_curve = streaming_precision_recall_curve(data, model.decoder, z, pr_thresholds,
+                                                           block_size=args.exact_block_size or 1024)
+            lsh_curve = sparse_precision_recall_curve(data, lsh_adjacency, pr_thresholds)
+
+            pr_curve = {'percentiles': pr_percentiles,
+                        'thresholds': pr_thresholds,
+                        'naive_precision': naive_curve[0],
+                        'naive_recall': naive_curve[1],
+                        'naive_auc': pr_auc(*naive_curve),
+                        'lsh_precision': lsh_curve[0],
+                        'lsh_recall': lsh_curve[1],
+                        'lsh_auc': pr_auc(*lsh_curve)}
+            print(f"Naive PR-AUC {pr_curve['naive_auc']}; LSH PR-AUC {pr_curve['lsh_auc']}")
+
+        return naive_precision, naive_recall, naive_time, naive_size, lsh_precision, lsh_recall, lsh_time, lsh_size, compare_precision, compare_recall, pr_curve
 
     # Training routine
     early_stopping = EarlyStopping(args.use_early_stopping, patience=args.early_stopping_patience, verbose=True)
@@ -221,7 +316,12 @@ def run_experiment(args):
 
     if not args.lsh:
         # Compute precision recall w.r.t the ground truth graph
-        graph_precision, graph_recall = test_naive_graph(latent_embeddings)
+        if args.stream_evaluation:
+            graph_precision, graph_recall = test_streamed_graph(latent_embeddings)
+        elif args.exact_block_size is not None:
+            graph_precision, graph_recall = test_exact_graph(latent_embeddings)
+        else:
+            graph_precision, graph_recall = test_naive_graph(latent_embeddings)
         del model
         del encoder
         del decoder
@@ -230,7 +330,7 @@ def run_experiment(args):
         # Precision w.r.t. the generated graph
         naive_precision, naive_recall, naive_time, naive_size, lsh_precision, \
         lsh_recall, lsh_time, lsh_size, \
-        compare_precision, compare_recall = test_compare_lsh_naive_graphs(
+        compare_precision, compare_recall, pr_curve = test_compare_lsh_naive_graphs(
             latent_embeddings)
 
         del model
@@ -250,7 +350,8 @@ def run_experiment(args):
                 'lsh_time': lsh_time,
                 'lsh_size': lsh_size,
                 'compare_precision': compare_precision,
-                'compare_recall': compare_recall}
+                'compare_recall': compare_recall,
+                'pr_curve': pr_curve}
 
         # results = np.append(np_result_file, args.dataset, args.lsh_bands, args.lsh_rows)
 
@@ -271,6 +372,15 @@ def run_grid_search(args):
     lsh_bands = [32, 16, 8]
     lsh_rows = [16, 32, 64, 128, 196]
 
+    # The tuner picks bands and rows for every run itself
+    if args.lsh_auto_tune:
+        lsh_bands, lsh_rows = [None], [None]
+
+    # A single run per combination evaluates all percentiles along a precision-recall curve, which is stored with
+    # the results of the lowest percentile
+    if args.pr_curve_percentiles:
+        percentiles = [min(args.pr_curve_percentiles)]
+
     for dset in datasets:
         train_from_scratch = True
         args.dataset = dset
@@ -278,11 +388,12 @@ def run_grid_search(args):
             args.min_sim = percentile
             for dist in distance_measures:
                 args.min_sim_absolute_value = None
+                args.pr_curve_thresholds = None
                 args.decoder = dist
                 for bands in lsh_bands:
-                    args.lsh_bands = bands
                     for rows in lsh_rows:
-                        args.lsh_rows = rows
+                        # Reset both, the tuner may have overwritten them in the previous combination
+                        args.lsh_bands, args.lsh_rows = bands, rows
                         print("Performing combination: ", args.dataset, args.decoder, args.lsh_bands, args.lsh_rows,
                               args.min_sim)
 
@@ -303,13 +414,16 @@ def run_grid_search(args):
                         results = run_experiment(args)
                         train_from_scratch = False
 
+                        # Name the results after the tuned parameters
+                        result_bands, result_rows = args.lsh_bands, args.lsh_rows
+
                         print("_______________________________Store Results______________________________")
 
                         filename = osp.join(results_folder,
                                             "GS_" + dset +
                                             "_" + dist +
-                                            "_" + str(bands) +
-                                            "_" + str(rows) +
+                                            "_" + str(result_bands) +
+                                            "_" + str(result_rows) +
                                             "_" + str(percentile) + ".pkl")
 
                         with open(filename, "wb") as f:
@@ -344,6 +458,28 @@ if __name__ == '__main__':
     parser.add_argument('--lsh', action='store_true', default=False, help="Use Local-Sensitivity-Hashing")
     parser.add_argument('--lsh-bands', type=int, default=8, help="Specify bands-parameter for LSH")
     parser.add_argument('--lsh-rows', type=int, default=64, help="Specify rows-parameter for LSH")
+    parser.add_argument('--lsh-probes', type=int, default=0,
+                        help="Number of neighboring buckets to probe per node and band (multi-probe LSH)")
+    parser.add_argument('--lsh-block-size', type=int, default=None,
+                        help="Number of nodes hashed at once when computing the LSH signature, all if not set")
+    parser.add_argument('--lsh-jobs', type=int, default=1, help="Number of threads hashing LSH bands in parallel")
+    parser.add_argument('--exact-block-size', type=int, default=None,
+                        help="Build the exact graph in blocks of this many rows as a sparse thresholded matrix "
+                             "instead of the dense adjacency matrix")
+    parser.add_argument('--stream-evaluation', action='store_true', default=False,
+                        help="Evaluate the exact graph by counting edges in blocks of --exact-block-size rows (1024 if "
+                             "not set) without building it")
+    parser.add_argument('--pr-curve-percentiles', type=float, nargs='+', default=None,
+                        help="Also evaluate both graphs at the thresholds of these percentiles in a single pass. The "
+                             "LSH graph is built for the lowest one and keeps float32 values")
+    parser.add_argument('--lsh-auto-tune', action='store_true', default=False,
+                        help="Choose LSH bands and rows from sampled similarities instead of --lsh-bands/--lsh-rows")
+    parser.add_argument('--lsh-target-recall', type=float, default=0.9,
+                        help="Recall w.r.t. the naive graph that the LSH auto-tuner aims for")
+    parser.add_argument('--lsh-output', type=str, default='csr', choices=['coo', 'csr', 'scipy'],
+                        help="Sparse format of the LSH adjacency matrix")
+    parser.add_argument('--lsh-values', type=str, default='float16', choices=['float32', 'float16', 'bool'],
+                        help="Value type of the LSH adjacency matrix for the CSR formats")
     parser.add_argument('--decoder', type=str, default='dot', help="Specify Decoder Type",
                         choices=['dot', 'cosine'])
 
@@ -360,6 +496,8 @@ if __name__ == '__main__':
                         help="Whether to use sampling in dense graph eval. Use when the full graph doesn't fit in the VRAM")
 
     args = parser.parse_args()
+    # Thresholds of --pr-curve-percentiles, sampled once and kept like --min-sim-absolute-value
+    args.pr_curve_thresholds = None
 
     if args.grid_search:
         run_grid_search(args)
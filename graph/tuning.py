@@ -0,0 +1,100 @@
+import os.path as path
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from graph.torch_lsh import CosineSimilarity, LSHDistanceMetric
+
+# Number of histogram bins the sampled collision probabilities are summarized with
+N_BINS = 1000
+
+
+def s_curve(p, bands: int, rows: int):
+    """
+    Probability that two nodes with a per-row collision probability p share a bucket in at least one band.
+    E.g. p = 1 - theta / pi for the angle theta between two vectors and random hyperplanes.
+    """
+    return 1 - (1 - p ** rows) ** bands
+
+
+def sample_collisions(embeddings, sim_thresh: float, metric: LSHDistanceMetric, sample_size: int = 1000):
+    """
+    Estimates the distribution of per-row collision probabilities over all node pairs from the pairs of a random
+    sample of nodes, similar to sample_percentile.
+    :return: (bin centers, fraction of all pairs per bin, fraction of all pairs per bin that reach sim_thresh)
+    """
+    N = embeddings.shape[0]
+    sample_size = min(sample_size, N)
+    sample_ix = np.random.choice(np.arange(N), size=sample_size, replace=False)
+    sample = torch.as_tensor(embeddings[sample_ix]).detach().float()
+
+    # The sample has to be hashed as part of all embeddings, e.g. lifted by their largest norm for dot products
+    metric = metric.fit(torch.as_tensor(embeddings).detach().float())
+
+    upper = torch.triu_indices(sample_size, sample_size, offset=1)
+    similarities = metric.pairwise_sim(sample)[upper[0], upper[1]].cpu().numpy()
+    probabilities = metric.pairwise_collision_probability(sample)[upper[0], upper[1]].cpu().numpy()
+
+    edges = np.linspace(0, 1, N_BINS + 1)
+    all_pairs = np.histogram(probabilities, bins=edges)[0] / len(probabilities)
+    similar_pairs = np.histogram(probabilities[similarities >= sim_thresh], bins=edges)[0] / len(probabilities)
+
+    return (edges[1:] + edges[:-1]) / 2, all_pairs, similar_pairs
+
+
+def tune_lsh(embeddings, sim_thresh: float, metric=CosineSimilarity, target_recall: float = 0.9,
+             bands_grid=range(1, 65), rows_grid=range(1, 129), sample_size: int = 1000, verbose: bool = True):
+    """
+    Picks the cheapest number of bands and rows that is predicted to find target_recall of all pairs with a
+    similarity of at least sim_thresh, instead of searching the grid by building the graphs.
+    Recall and number of candidates follow from the S-curve of every configuration averaged over the sampled collision
+    probabilities. The cost counts the multiply-adds of hashing all nodes and of verifying all distinct candidates.
+    :param embeddings: tensor of shape (N, D)
+    :param metric: LSHDistanceMetric class as passed to LSHDecoder
+    :return: (best, predictions) where predictions is a list with a dict of the predicted recall, distinct
+     candidate pairs, edges, cost and memory in MB of every configuration and best is the cheapest one that meets the
+     target, or the one with the highest recall if none does
+    """
+    N, D = embeddings.shape
+    n_pairs = N * (N - 1) / 2
+    p, all_pairs, similar_pairs = sample_collisions(embeddings, sim_thresh, metric(1, 1, seed=0), sample_size)
+
+    if similar_pairs.sum() == 0:
+        raise ValueError(f"No sampled pair reaches a similarity of {sim_thresh}, increase sample_size")
+
+    predictions = []
+    for rows in rows_grid:
+        key_words = metric(1, rows, seed=0).key_words()
+
+        for bands in bands_grid:
+            found = s_curve(p, bands, rows)
+            recall = (found * similar_pairs).sum() / similar_pairs.sum()
+            candidates = (found * all_pairs).sum() * n_pairs
+
+            predictions.append({'bands': bands,
+                                'rows': rows,
+                                'recall': recall,
+                                'candidates': candidates,
+                                'edges': recall * similar_pairs.sum() * n_pairs,
+                                'cost': (bands * rows * N + candidates) * D,
+                                'signature_mb': bands * key_words * N * 8 / 10 ** 6,
+                                # Keys of the seen candidates and the COO output of both directions of every edge
+                                'pairs_mb': (candidates * 8 + recall * similar_pairs.sum() * n_pairs * 40) / 10 ** 6})
+
+    feasible = [prediction for prediction in predictions if prediction['recall'] >= target_recall]
+    if feasible:
+        best = min(feasible, key=lambda prediction: prediction['cost'])
+    else:
+        best = max(predictions, key=lambda prediction: prediction['recall'])
+        if verbose:
+            print(f"No configuration reaches a recall of {target_recall}, using the one with the highest recall.")
+
+    if verbose:
+        print(f"Tuned LSH to {best['bands']} bands and {best['rows']} rows: predicted recall {best['recall']:.3f} "
+              f"with {best['candidates']:.0f} candidate pairs, {best['signature_mb']:.1f} MB signature and "
+              f"{best['pairs_mb']:.1f} MB pairs.")
+
+    return best, predictions
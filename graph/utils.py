@@ -3,69 +3,203 @@ import random
 from os import path as osp
 
 import numpy as np
+import scipy.sparse as sp
 import torch
 from torch_geometric import transforms as T
 from torch_geometric.datasets import CoraFull, Coauthor, Planetoid, Reddit
 from torch_geometric.nn.models.autoencoder import negative_sampling
 from torch_geometric.utils import to_undirected
-from tqdm import tqdm
 
 from graph.datasets.snap import Amazon
+from graph.lsh import sorted_unique
+
+
+def sparse_edges(sparse_matrix):
+    """
+    :param sparse_matrix: torch COO or CSR tensor or scipy sparse matrix, e.g. any output of LSHDecoder
+    :return: (n_edges, 2) numpy array with the distinct coordinates of the stored entries
+    """
+    if sp.issparse(sparse_matrix):
+        sparse_matrix = sparse_matrix.tocoo()
+        sparse_matrix.sum_duplicates()
+        return np.stack((sparse_matrix.row, sparse_matrix.col), axis=1)
+
+    if sparse_matrix.layout == torch.sparse_csr:
+        crow_indices = sparse_matrix.crow_indices().detach().cpu().long()
+        rows = torch.repeat_interleave(torch.arange(sparse_matrix.size(0)), crow_indices[1:] - crow_indices[:-1])
+        return torch.stack((rows, sparse_matrix.col_indices().detach().cpu().long()), dim=1).numpy()
+
+    return sparse_matrix.coalesce().indices().t().detach().cpu().numpy()
+
+
+def sparse_entries(sparse_matrix):
+    """
+    :param sparse_matrix: See sparse_edges, with distinct coordinates as LSHDecoder outputs them
+    :return: ((n_edges, 2) numpy array of coordinates, float32 tensor with the values of the entries)
+    """
+    if sp.issparse(sparse_matrix):
+        sparse_matrix = sparse_matrix.tocoo()
+        values = sparse_matrix.data
+    elif sparse_matrix.layout == torch.sparse_csr:
+        values = sparse_matrix.values()
+    else:
+        values = sparse_matrix.coalesce().values()
+
+    values = torch.as_tensor(values).detach().cpu()
+    if values.dtype == torch.bool:
+        raise ValueError("Sparse matrix stores no similarity values")
+
+    return sparse_edges(sparse_matrix), values.float()
+
+
+def sparse_size(sparse_matrix):
+    """
+    :return: Memory of the indices and values of a sparse matrix in MB, see sparse_edges for the supported formats
+    """
+    if sp.issparse(sparse_matrix):
+        sparse_matrix = sparse_matrix.tocsr()
+        n_bytes = sparse_matrix.data.nbytes + sparse_matrix.indices.nbytes + sparse_matrix.indptr.nbytes
+    elif sparse_matrix.layout == torch.sparse_csr:
+        parts = [sparse_matrix.crow_indices(), sparse_matrix.col_indices(), sparse_matrix.values()]
+        n_bytes = sum(part.element_size() * part.nelement() for part in parts)
+    else:
+        parts = [sparse_matrix._indices(), sparse_matrix._values()]
+        n_bytes = sum(part.element_size() * part.nelement() for part in parts)
+
+    return n_bytes / 10 ** 6
 
 
 def sparse_precision_recall(data, sparse_matrix, verbose=True):
     print("Compute Sparse-Precision-Recall")
-    all_edges = extract_all_edges_from_graph_data(data)
+    pred = sparse_edges(sparse_matrix)
+    true = extract_all_edges_from_graph_data(data)
 
-    pred = sparse_matrix.coalesce().indices().t().detach().cpu().numpy()
-    pred = set(zip(pred[:, 0], pred[:, 1]))
-    true = set(zip(all_edges[:, 0], all_edges[:, 1]))
-
-    print(f"Sparse Precision-Recall: {len(pred)} edges detected by LSH out of {len(true)} in total.")
-    return evaluate_edges(pred, true, verbose)
+    return evaluate_edges(pred, true, verbose, name="Sparse Precision-Recall", detected_by=" by LSH")
 
 
 def dense_precision_recall(data, dense_matrix, min_sim, verbose=True):
     if verbose:
         print("Compute Dense-Precision-Recall")
 
-    all_edges = extract_all_edges_from_graph_data(data)
-    pred = (dense_matrix.detach().cpu().numpy() > min_sim).nonzero()
+    pred = np.argwhere(dense_matrix.detach().cpu().numpy() > min_sim)
+    true = extract_all_edges_from_graph_data(data)
 
-    pred = set(zip(pred[0], pred[1]))
-    true = set(zip(all_edges[:, 0], all_edges[:, 1]))
+    return evaluate_edges(pred, true, verbose, name="Dense Precision-Recall" if verbose else None)
 
+
+def streaming_precision_recall(data, decoder, z, min_sim, block_size=1024, sigmoid=False, verbose=True):
+    """
+    Same as dense_precision_recall on decoder.forward_all(z, sigmoid), but walks the similarities in row blocks of the
+    decoder's forward_blocks and only counts the true and all predicted edges of every block. Neither the dense
+    matrix nor its thresholded mask is ever held in memory, and the blocks stay on the device of z.
+    :param decoder: BlockwiseDecoder
+    :return: (precision, recall)-tuple
+    """
     if verbose:
-        print(f"Dense Precision-Recall: {len(pred)} edges detected out of {len(true)} in total.")
+        print("Compute Streaming-Precision-Recall")
 
-    return evaluate_edges(pred, true, verbose)
+    precision, recall = streaming_precision_recall_curve(data, decoder, z, [min_sim], block_size=block_size,
+                                                         sigmoid=sigmoid, verbose=verbose)
+    return float(precision[0]), float(recall[0])
 
 
-def sampled_dense_precision_recall(data, sampled_dense_matrix, ix_mapping, min_sim, verbose=True):
+def streaming_precision_recall_curve(data, decoder, z, thresholds, block_size=1024, sigmoid=False, verbose=True):
+    """
+    Precision and recall of the graphs forward_all(z, sigmoid) > threshold for all thresholds at once, counted in a
+    single pass over the row blocks of the decoder like streaming_precision_recall.
+    :param thresholds: ascending similarity thresholds
+    :return: (precision, recall)-tuple of numpy arrays with a value for every threshold
+    """
+    N = z.size(0)
+    thresholds = torch.as_tensor(np.asarray(thresholds, dtype=np.float32), device=z.device)
+    true_keys = edge_keys(extract_all_edges_from_graph_data(data), N)
+    # Keys are sorted by row, so the true edges of a block are a contiguous slice
+    block_starts = np.searchsorted(true_keys, np.arange(0, N + block_size, block_size) * N)
+
+    n_pred, n_found = 0, 0
+    for block_ix, (start, block) in enumerate(decoder.forward_blocks(z, block_size=block_size, sigmoid=sigmoid)):
+        block_keys = torch.from_numpy(true_keys[block_starts[block_ix]:block_starts[block_ix + 1]]).to(block.device)
+
+        n_pred += threshold_counts(block, thresholds)
+        n_found += threshold_counts(block[block_keys // N - start, block_keys % N], thresholds)
+
     if verbose:
-        print("Compute Sampled Dense-Precision-Recall")
+        print(f"Streaming Precision-Recall: {n_pred.tolist()} edges detected out of {len(true_keys)} in total.")
 
-    embedding_indices = set(ix_mapping.values())
-    relevant_edges = []
+    return _precision_recall(n_found, n_pred, len(true_keys))
 
-    for edge in extract_all_edges_from_graph_data(data):
-        if edge[0] in embedding_indices and edge[1] in embedding_indices:
-            relevant_edges.append(edge)
 
-    relevant_edges = np.array(relevant_edges)
+def sparse_precision_recall_curve(data, sparse_matrix, thresholds, verbose=True):
+    """
+    Precision and recall of the edges of a sparse graph whose value is above each of the thresholds, e.g. of the
+    LSH graph for sim_thresh = thresholds[0], which contains the LSH graphs of all larger thresholds.
+    :param thresholds: ascending similarity thresholds
+    :return: (precision, recall)-tuple of numpy arrays with a value for every threshold
+    """
+    N = sparse_matrix.shape[0]
+    thresholds = torch.as_tensor(np.asarray(thresholds, dtype=np.float32))
+    true_keys = edge_keys(extract_all_edges_from_graph_data(data), N)
 
-    pred = (sampled_dense_matrix.detach().cpu().numpy() > min_sim).nonzero()
+    edges, values = sparse_entries(sparse_matrix)
+    keys = edges[:, 0].astype(np.int64) * N + edges[:, 1]
+    # Index of every key in the sorted true keys, or of a different key if it is not a true edge
+    found = np.minimum(np.searchsorted(true_keys, keys), len(true_keys) - 1)
+    is_true = (true_keys[found] == keys) if len(true_keys) else np.zeros(len(keys), dtype=bool)
+
+    n_pred = threshold_counts(values, thresholds)
+    n_found = threshold_counts(values[torch.from_numpy(is_true)], thresholds)
+
+    if verbose:
+        print(f"Sparse Precision-Recall: {n_pred.tolist()} edges detected out of {len(true_keys)} in total.")
+
+    return _precision_recall(n_found, n_pred, len(true_keys))
+
+
+def threshold_counts(values, thresholds):
+    """
+    :param values: tensor of similarities
+    :param thresholds: ascending 1-D tensor of thresholds on the device of values
+    :return: LongTensor with the number of values above every threshold, counted in one pass
+    """
+    # Values in bucket i lie in (thresholds[i - 1], thresholds[i]], so they are above the thresholds before i
+    buckets = torch.bucketize(values.flatten().to(thresholds.dtype), thresholds)
+    counts = torch.bincount(buckets, minlength=len(thresholds) + 1)
+    return counts.flip(0).cumsum(0).flip(0)[1:].cpu()
+
+
+def _precision_recall(n_found, n_pred, n_true):
+    n_found, n_pred = np.asarray(n_found, dtype=np.float64), np.asarray(n_pred, dtype=np.float64)
+    has_pred = n_pred != 0
+
+    precision = np.where(has_pred, n_found / np.maximum(n_pred, 1), 0)
+    recall = np.where(has_pred, n_found / max(n_true, 1), 0)
+    return precision, recall
 
-    # Apply index transformation to the retrieved indices
-    pred = np.vectorize(ix_mapping.get)(pred)
 
-    pred = set(zip(pred[0], pred[1]))
-    true = set(zip(relevant_edges[:, 0], relevant_edges[:, 1]))
+def pr_auc(precision, recall):
+    """
+    Area under the precision-recall curve with the trapezoidal rule, over the range of recall the curve covers
+    """
+    order = np.argsort(recall, kind='stable')
+    precision, recall = np.asarray(precision)[order], np.asarray(recall)[order]
+
+    return float(np.sum(np.diff(recall) * (precision[1:] + precision[:-1]) / 2))
+
 
+def sampled_dense_precision_recall(data, sampled_dense_matrix, ix_mapping, min_sim, verbose=True):
     if verbose:
-        print(f"Dense Precision-Recall: {len(pred)} edges detected out of {len(true)} in total.")
+        print("Compute Sampled Dense-Precision-Recall")
+
+    embedding_indices = np.fromiter(ix_mapping.values(), dtype=np.int64)
+    all_edges = extract_all_edges_from_graph_data(data)
+    relevant_edges = all_edges[np.isin(all_edges, embedding_indices).all(axis=1)]
 
-    return evaluate_edges(pred, true, verbose)
+    # Apply index transformation to the retrieved indices
+    mapping = np.zeros(max(ix_mapping) + 1, dtype=np.int64)
+    mapping[np.fromiter(ix_mapping.keys(), dtype=np.int64)] = embedding_indices
+    pred = mapping[np.argwhere(sampled_dense_matrix.detach().cpu().numpy() > min_sim)]
+
+    return evaluate_edges(pred, relevant_edges, verbose, name="Dense Precision-Recall" if verbose else None)
 
     # Must remove non-relevant indices from all_edges. Might also try to multiply recall by len(data)/len(ix_mapping) to re-normalize it.
 
@@ -73,46 +207,58 @@ def sampled_dense_precision_recall(data, sampled_dense_matrix, ix_mapping, min_s
 def sparse_v_dense_precision_recall(dense_matrix, sparse_matrix, min_sim, verbose=True):
     """
     Compares Sparse-Adjacency matrix (LSH-Version) to the Dense-Adjacency matrix (non-LSH-version), which serves as GT.
-    :param dense_matrix:
+    :param dense_matrix: Dense matrix, or a sparse matrix that is already thresholded like forward_thresholded's
     :param sparse_matrix:
     :param min_sim_percentile:
     :return:
     """
 
-    dense_pred = (dense_matrix.detach().cpu().numpy() > min_sim).nonzero()
-    dense_pred = set(zip(dense_pred[0], dense_pred[1]))
+    if dense_matrix.is_sparse:
+        dense_pred = sparse_edges(dense_matrix)
+    else:
+        dense_pred = np.argwhere(dense_matrix.detach().cpu().numpy() > min_sim)
 
-    sparse_pred = sparse_matrix.coalesce().indices().t().detach().cpu().numpy()
-    sparse_pred = set(zip(sparse_pred[:, 0], sparse_pred[:, 1]))
+    sparse_pred = sparse_edges(sparse_matrix)
+    n_sparse, n_dense = len(edge_keys(sparse_pred)), len(edge_keys(dense_pred))
 
-    print(f"LSH found {len(sparse_pred)} edges out of {len(dense_pred)} edges that the naive version predicted.")
+    print(f"LSH found {n_sparse} edges out of {n_dense} edges that the naive version predicted.")
     return evaluate_edges(sparse_pred, dense_pred, verbose)
 
 
-def evaluate_edges(pred, true, verbose=True):
+def edge_keys(edges, n_nodes=None):
     """
-    Calculates precision and recall for the predicted connections
-    :return: (precision, recall)-tuple
+    Encodes edges as sorted distinct int64 keys i * n_nodes + j, so that sets of edges can be compared with array
+    operations instead of sets of tuples.
+    :param edges: (n_edges, 2) array of node indices
+    :param n_nodes: Number of nodes, defaults to the largest index + 1. Must be the same for compared edges
+    :return: sorted numpy array of distinct keys
     """
-    sum = 0.0
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    if n_nodes is None:
+        n_nodes = int(edges.max()) + 1 if len(edges) else 1
 
-    prec_loop = pred if not verbose else tqdm(pred, desc="Checking precision")
+    return sorted_unique(edges[:, 0] * n_nodes + edges[:, 1])
 
-    for conn in prec_loop:
-        if conn in true:
-            sum += 1.0
 
-    precision = (sum / len(pred)) if len(pred) != 0 else 0
-
-    sum = 0.0
+def evaluate_edges(pred, true, verbose=True, name=None, detected_by=""):
+    """
+    Calculates precision and recall for the predicted connections. Duplicate edges count once.
+    :param pred: (n_edges, 2) array of predicted edges
+    :param true: (n_edges, 2) array of true edges
+    :param name: If given, prints the number of distinct predicted and true edges under this name
+    :return: (precision, recall)-tuple
+    """
+    pred, true = np.asarray(pred).reshape(-1, 2), np.asarray(true).reshape(-1, 2)
+    n_nodes = int(max(pred.max(initial=-1), true.max(initial=-1))) + 1
 
-    rec_loop = true if not verbose else tqdm(true, desc="Checking recall")
+    pred_keys, true_keys = edge_keys(pred, n_nodes), edge_keys(true, n_nodes)
+    n_found = len(np.intersect1d(pred_keys, true_keys, assume_unique=True))
 
-    for conn in rec_loop:
-        if conn in pred:
-            sum += 1.0
+    if name is not None:
+        print(f"{name}: {len(pred_keys)} edges detected{detected_by} out of {len(true_keys)} in total.")
 
-    recall = (sum / len(true)) if len(pred) != 0 else 0
+    precision = (n_found / len(pred_keys)) if len(pred_keys) != 0 else 0
+    recall = (n_found / len(true_keys)) if len(pred_keys) != 0 else 0
     return precision, recall
 
 